@@ -0,0 +1,373 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _configuration import Configuration, strip_comments
+from _fileMover import FileMover
+from _pipeline import PIPELINE_STAGES, Pipeline
+from _profiler import profiler
+from _runJournal import RunJournal
+from _signer import GpgSigner
+from _targetRelease import PACKAGE_KINDS, SharedCache
+from _verifyRepository import hash_file
+
+
+# One lock for each output path, held while it is published, so that no two
+# builds in one process write to the same output at once
+OUTPUT_LOCKS = SharedCache()
+
+
+def build_targets(targets: list, runtime_config: dict, journal: RunJournal = None, on_finished=None) -> tuple:
+    # Downloads and packages the targets through a pipeline of stages (see
+    # Pipeline). Returns the targets which have packages to publish, the
+    # (target, error) of each target which failed and the seconds each target
+    # took, by target_id. on_finished(target, error) is called as each target
+    # is done, while the others carry on.
+    built = []
+    failed = []
+    lock = threading.Lock()
+
+    # Targets which come out the same in several configs are built once, and
+    # the others take the packages of the first
+    leaders = {}
+    followers = {}
+    for target in targets:
+        if target.target_id in leaders:
+            followers[target.target_id].append(target)
+        else:
+            leaders[target.target_id] = target
+            followers[target.target_id] = []
+
+    def finished(target, error):
+        with lock:
+            if error is not None:
+                # Quarantine this target, so the rest can still be published
+                # (along with what it published before, see carry_forward)
+                logging.error(
+                    f"{target.result['owner']}/{target.result['repo']} ({target.target_id}) failed, and will not be built: {error}")
+                failed.append((target, error))
+            else:
+                for kind in PACKAGE_KINDS:
+                    if f"{kind}_package" in target.result:
+                        logging.info(
+                            f"{target.result['repo']}/{target.result['owner']} release of {target.result['name']} for {target.result['architecture']} obtained and packaged: {target.result[f'{kind}_package']}")
+                if 'deb_package' in target.result or 'rpm_package' in target.result:
+                    built.append(target)
+
+            for follower in followers[target.target_id]:
+                if error is not None:
+                    failed.append((follower, error))
+                elif target in built and follower.config["builddir"] != target.config["builddir"]:
+                    # Anything else is the same package again, for the same output
+                    follower.adoptBuild(target)
+                    built.append(follower)
+
+        if on_finished is not None:
+            for done in [target] + followers[target.target_id]:
+                on_finished(done, error)
+
+    stage_jobs = {
+        stage: runtime_config.get("stage_jobs", {}).get(name, runtime_config["jobs"])
+        for stage, name in PIPELINE_STAGES.items()
+    }
+    pipeline = Pipeline(stage_jobs, journal, finished)
+    pipeline.run(list(leaders.values()))
+
+    for target in leaders.values():
+        for build_report in target.result.get('build_report', []):
+            saved = ""
+            if build_report.get('bytes_saved') is not None:
+                saved = f", {build_report['bytes_saved']} bytes saved by stripping"
+            logging.info(
+                f"Built {build_report['package']} with {build_report['compression']} compression (level: {build_report['compression_level'] if build_report['compression_level'] is not None else 'default'}) in {build_report['seconds']}s, {build_report['bytes']} bytes{saved}")
+
+    # In the order of the config, whichever finished first
+    order = {id(target): index for index, target in enumerate(targets)}
+    built.sort(key=lambda target: order[id(target)])
+    failed.sort(key=lambda failure: order[id(failure[0])])
+    return built, failed, pipeline.seconds
+
+
+class RepositoryPublisher:
+    # Publishes one output. The packages of each target are added to its pool
+    # as soon as the target is built, and the output is indexed once the last
+    # of its targets is done. targets are all of the targets of the output,
+    # built or not, in the order of the config.
+    def __init__(self, targets: list, runtime_config: dict):
+        self.targets = targets
+        self.runtime_config = runtime_config
+        self.pending = len(targets)
+        self.built = []
+        self.failed = []
+        self.error = None
+        self.support = None
+        self.lock = threading.Lock()
+        # Held from the first package added until the output is published,
+        # so that no two builds in one process write to the same output at once
+        self.output_lock = OUTPUT_LOCKS.get(
+            os.path.realpath(runtime_config["path"]), threading.Lock)
+
+    def add(self, target):
+        from _makeRepositories import MakeRepository, add_to_pool
+
+        try:
+            with self.lock:
+                if self.support is None:
+                    self.output_lock.acquire()
+                    try:
+                        self.support = MakeRepository(self.runtime_config, set(
+                            package_format for configured in self.targets for package_format in configured.result['formats']))
+                    except Exception:
+                        self.output_lock.release()
+                        raise
+                self.built.append(target)
+            with profiler.stage("pool"):
+                add_to_pool(target, self.runtime_config)
+        except Exception as e:
+            # Raised when the output is published, from the thread which does that
+            with self.lock:
+                self.error = self.error or e
+
+    def finished(self, target, error: Exception = None) -> bool:
+        # Called once for each target of the output. Returns True for the
+        # last of them, when the output is ready to publish.
+        if error is None and ('deb_package' in target.result or 'rpm_package' in target.result):
+            self.add(target)
+        elif error is not None:
+            with self.lock:
+                self.failed.append(target)
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+    def publish(self) -> dict:
+        # Indexes and signs the output, and returns the seconds each step
+        # took. The targets which failed keep what they had in the last run.
+        from _makeRepositories import MakeDebRepository, MakeRPMRepository, carry_forward, output_path, pool_files
+
+        if self.support is None:
+            if self.error is not None:
+                raise self.error
+            return {}
+        try:
+            if self.error is not None:
+                raise self.error
+            claimed = set(os.path.relpath(pool_file, output_path(self.runtime_config))
+                          for target in self.built for package_format in ["deb", "rpm"]
+                          for pool_file in pool_files(target, package_format))
+            carried = [target for target in self.failed if carry_forward(target, self.runtime_config, claimed)]
+            order = {id(target): index for index, target in enumerate(self.targets)}
+            targets = sorted(self.built + carried, key=lambda target: order.get(id(target), len(order)))
+            timings = {}
+            debs = [target for target in targets if len(pool_files(target, 'deb')) > 0]
+            rpms = [target for target in targets if len(pool_files(target, 'rpm')) > 0]
+
+            if len(debs) > 0:
+                start = time.monotonic()
+                with profiler.stage("repository_deb"):
+                    MakeDebRepository(debs, self.runtime_config)
+                timings["deb"] = round(time.monotonic() - start, 3)
+
+            if len(rpms) > 0:
+                start = time.monotonic()
+                with profiler.stage("repository_rpm"):
+                    MakeRPMRepository(rpms, self.runtime_config)
+                timings["rpm"] = round(time.monotonic() - start, 3)
+
+            self.support.finalize(targets)
+            return timings
+        finally:
+            self.output_lock.release()
+
+
+def publish_repository(targets: list, runtime_config: dict) -> dict:
+    # Moves the packages of the targets into the output, indexes and signs
+    # it, and returns the seconds each step took
+    publisher = RepositoryPublisher(targets, runtime_config)
+    for target in targets:
+        publisher.add(target)
+    return publisher.publish()
+
+
+def build_and_publish(targets: list, runtime_config: dict, outputs: list, journal: RunJournal = None) -> tuple:
+    # As build_targets, and publishes each of the outputs (the runtime_config
+    # of each) with the packages of the targets which write to it. An output
+    # is indexed as soon as the last of its targets is done, while the
+    # targets of other outputs carry on. Returns the built and failed targets
+    # and seconds of build_targets, and the timings of each output by path.
+    publishers = {}
+    for output in outputs:
+        output_path = os.path.realpath(output["path"])
+        publishers[output_path] = RepositoryPublisher(
+            [target for target in targets if os.path.realpath(target.config["path"]) == output_path], output)
+
+    timings = {}
+    with ThreadPoolExecutor(max_workers=max(len(publishers), 1)) as indexers:
+        publications = []
+
+        def finished(target, error):
+            output_path = os.path.realpath(target.config["path"])
+            if publishers[output_path].finished(target, error):
+                publications.append(
+                    (output_path, indexers.submit(publishers[output_path].publish)))
+
+        built, failed, seconds = build_targets(targets, runtime_config, journal, finished)
+        for output_path, publication in publications:
+            timings[output_path] = publication.result()
+    return built, failed, seconds, timings
+
+
+class BuildService:
+    # Builds repositories in-process, for a long running worker which takes
+    # one build request after another. The HTTP session, the cache of
+    # downloaded and unpacked assets and the signer (with its key already
+    # imported) are made once and shared by every build, as is the workspace
+    # the downloads are kept in. For example:
+    #
+    #   signer = GpgSigner(gnupghome)
+    #   signer.import_key(private_key)
+    #   service = BuildService(workspace="/var/cache/repo-to-repo", signer=signer)
+    #   result = service.build("config.json", repository="/srv/repo", targets=["owner/repo"])
+    #
+    # Releases are looked up afresh for each build, so new releases are seen.
+    # The workspace may be cleaned up between builds, and anything the cache
+    # holds from it is then fetched again.
+    def __init__(self, workspace: str = None, session=None, cache: SharedCache = None, signer: GpgSigner = None, jobs: int = None, quiet: bool = True):
+        self.owns_workspace = workspace is None
+        if workspace is None:
+            workspace = tempfile.mkdtemp(prefix="repo-to-repo-")
+        self.workspace = os.path.abspath(workspace)
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self.cache = cache or SharedCache()
+        self.signer = signer or GpgSigner()
+        self.jobs = jobs or os.cpu_count()
+        self.quiet = quiet
+        self.file_mover = FileMover()
+        # The workspace is shared, so builds take turns
+        self.lock = threading.Lock()
+
+    def _runtimeConfig(self, clean: bool, timestamp: str) -> dict:
+        builddir = os.path.join(self.workspace, 'builddir')
+        # Anything left here is from a build which failed part way through
+        if os.path.exists(builddir):
+            shutil.rmtree(builddir)
+        os.makedirs(builddir)
+        workdir = os.path.join(self.workspace, 'workdir')
+        os.makedirs(workdir, exist_ok=True)
+        # The downloads and unpacked trees may have been cleaned up since the
+        # last build, so the cache forgets any which are gone
+        self.cache.prune(os.path.exists)
+        return {
+            "quiet": self.quiet,
+            "clean": clean,
+            "timestamp": timestamp,
+            "validate": False,
+            "resume": False,
+            "jobs": self.jobs,
+            "basedir": self.workspace,
+            "workdir": workdir,
+            "builddir": builddir,
+            "file_mover": self.file_mover,
+            "release_cache": SharedCache(),
+            "asset_cache": self.cache,
+            "session": self.session,
+            "signer": self.signer,
+            "gnupghome": self.signer.gnupghome,
+            "privatekey_id": self.signer.key_id,
+            "privatekey_uid": self.signer.uid
+        }
+
+    def _selected(self, target, selectors: list) -> bool:
+        # A target is picked by its target_id, "owner/repo" or package name
+        return any(selector in [
+            target.target_id,
+            f"{target.result['owner']}/{target.result['repo']}",
+            target._packageName()
+        ] for selector in selectors)
+
+    def build(self, config, repository: str = None, targets: list = None, clean: bool = False, timestamp: str = "%Y%m%d%H%M%S") -> dict:
+        # Builds the targets of config (a config file, or the same content
+        # already parsed) into repository (by default, the path in config).
+        # With targets, only the matching targets are built, and the
+        # repository holds those alone, as if config listed nothing else.
+        start = time.monotonic()
+        if isinstance(config, str):
+            with open(config, "r") as file:
+                config = json.loads(strip_comments(file.read()))
+        if repository is not None:
+            config = dict(config, path=repository)
+
+        with self.lock:
+            runtime_config = self._runtimeConfig(clean, timestamp)
+            configuration = Configuration(runtime_config=runtime_config)
+            configuration.get_targets(config)
+            selected = configuration.targets
+            if targets is not None:
+                selected = [target for target in selected if self._selected(target, targets)]
+            configured = time.monotonic()
+
+            built, failed, seconds, timings = build_and_publish(
+                selected, runtime_config, [runtime_config])
+            packaged = time.monotonic()
+            repository_timings = timings.get(os.path.realpath(runtime_config["path"]), {})
+
+        if runtime_config["pathmode"] is None:
+            snapshot = runtime_config["path"]
+        else:
+            snapshot = os.path.join(runtime_config["path"], runtime_config["pathmode"])
+        return {
+            "repository": snapshot if len(built) > 0 else None,
+            "packages": self._packages(built, seconds),
+            "failed": [{
+                "target": target.target_id,
+                "owner": target.result['owner'],
+                "repo": target.result['repo'],
+                "error": str(error)
+            } for target, error in failed],
+            "timings": dict(repository_timings, **{
+                "configuration": round(configured - start, 3),
+                "targets": round(packaged - configured, 3),
+                "total": round(time.monotonic() - start, 3)
+            })
+        }
+
+    def _packages(self, targets: list, seconds: dict) -> list:
+        packages = []
+        for target in targets:
+            builds = {build_report['package']: build_report
+                      for build_report in target.result.get('build_report', [])}
+            for kind, package_format in PACKAGE_KINDS.items():
+                pool_file = target.result.get(f"{kind}_pool_file")
+                if pool_file is None:
+                    continue
+                build = builds.get(os.path.basename(pool_file))
+                packages.append({
+                    "target": target.target_id,
+                    "owner": target.result['owner'],
+                    "repo": target.result['repo'],
+                    "format": package_format,
+                    "name": target._packageName(kind),
+                    "version": target.result.get('versionNumber'),
+                    "architecture": target.result['architecture'],
+                    "path": pool_file,
+                    "bytes": os.path.getsize(pool_file),
+                    "sha256": hash_file(pool_file, ['sha256'])['sha256'],
+                    # Not built this time when the published package was reused
+                    "built": build is not None,
+                    "build_seconds": build['seconds'] if build is not None else None,
+                    "bytes_saved": build.get('bytes_saved') if build is not None else None,
+                    "target_seconds": seconds.get(target.target_id)
+                })
+        return packages
+
+    def close(self):
+        if self.owns_workspace and os.path.exists(self.workspace):
+            shutil.rmtree(self.workspace)
@@ -1,21 +1,103 @@
-
+import copy
 import os
 import json
+import hashlib
+import itertools
 import base64
+import fcntl
 import re
 import shutil
 import logging
+from collections import ChainMap
 from datetime import datetime
-import tempfile
-import subprocess
 
-from _exceptions import PGPLoadError, NoConfigurationFileFound, NoTargetPathDefined, ConfigErrorNoRepositories
-from _targetRelease import TargetRelease
+from _exceptions import PGPLoadError, NoConfigurationFileFound, NoTargetPathDefined, ConfigErrorNoRepositories, WorkspaceInUse
+from _fileMover import FileMover
+from _pipeline import PIPELINE_STAGES
+from _profiler import redact_secrets
+from _runJournal import RunJournal
+from _signer import GpgSigner
+from _targetRelease import TargetRelease, SharedCache, map_architecture
+
+# Every field of a target, as (name, default, can be set at the top level of
+# the config, can be set per target). A field is taken from the target, then
+# the repo, then the top level, then the default here.
+TARGET_FIELDS = (
+    ("platform", "github", True, False),
+    ("source_path", "", True, False),
+    ("architecture", "amd64", True, True),
+    ("formats", ["deb", "rpm"], True, True),
+    ("suite", "misc", True, False),
+    ("archive", "main", True, False),
+    ("homepage", "", True, True),
+    ("maintainer", "", True, True),
+    ("description", "", True, True),
+    ("priority", "optional", True, True),
+    ("debian_compression", "", True, True),
+    ("debian_compression_level", None, True, True),
+    ("redhat_compression", "", True, True),
+    ("redhat_compression_level", None, True, True),
+    ("keep_versions", 1, True, True),
+    ("strip", "", True, True),
+    ("debug_package", False, True, True),
+    ("target_binary", "", False, False),
+    ("autocomplete", {}, False, False),
+    ("version_match", "", False, True),
+    ("debian_dependencies", "", False, True),
+    ("redhat_dependencies", "", False, True),
+    ("package_name", "", False, True),
+    ("binaries", [], False, True),
+    ("split_binaries", False, False, True)
+)
+REPO_FIELDS = ("owner", "repo") + tuple(field[0] for field in TARGET_FIELDS)
+TARGET_OVERRIDES = frozenset(field[0] for field in TARGET_FIELDS if field[3])
+
+# Worked out from the repo when a repo leaves these empty
+REPO_FALLBACKS = {
+    "homepage": lambda repo: f"https://github.com/{repo['owner']}/{repo['repo']}",
+    "maintainer": lambda repo: f"{repo['owner']} <{repo['owner']}@users.noreply.github.com>",
+    "description": lambda repo: f"A repo-to-repo package of a release at https://github.com/{repo['owner']}/{repo['repo']}",
+    "package_name": lambda repo: repo['repo']
+}
+
+# A // comment runs to the end of the line, unless it is inside a string (as
+# in "https://...")
+JSON_COMMENT = re.compile(r'("(?:\\.|[^"\\])*")|//.*')
+
+
+def config_files(paths) -> list:
+    # Each path is a config file, or a directory of them (*.json)
+    if paths is None:
+        return []
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name)
+                            for name in os.listdir(path) if name.endswith('.json'))
+        else:
+            files.append(path)
+    return files
+
+
+def strip_comments(content: str) -> str:
+    # Strings cannot span lines, so only lines with a // need a closer look
+    lines = content.split("\n")
+    for number, line in enumerate(lines):
+        if "//" in line:
+            lines[number] = JSON_COMMENT.sub(r'\1', line)
+    return "\n".join(lines)
 
 
 class Configuration:
     def __init__(self, config_file: str = None, pgp_privatekey_filename: str = None, arguments=None, runtime_config: dict = None):
-        self.config_file = os.environ.get('config_file') or config_file
+        # Several config files (or directories of them) can be built in one
+        # run, sharing the downloads, connections and key between them
+        self.config_files = config_files(
+            os.environ.get('config_file') or config_file)
+        self.config_file = self.config_files[0] if len(
+            self.config_files) > 0 else None
         self.pgp_privatekey_filename = os.environ.get(
             'pgp_key') or pgp_privatekey_filename
         self.arguments = arguments
@@ -29,6 +111,11 @@ class Configuration:
             self.runtime_config["output_path"] = arguments.output_path
             self.runtime_config["clean"] = arguments.clean
             self.runtime_config["timestamp"] = arguments.timestamp
+            self.runtime_config["validate"] = arguments.validate
+            self.runtime_config["resume"] = arguments.resume
+            self.runtime_config["jobs"] = arguments.jobs or os.cpu_count()
+            if arguments.workspace is not None:
+                self.runtime_config["workspace"] = arguments.workspace
         else:
             if "quiet" not in self.runtime_config:
                 self.runtime_config["quiet"] = False
@@ -38,63 +125,114 @@ class Configuration:
                 self.runtime_config["clean"] = False
             if "timestamp" not in self.runtime_config:
                 self.runtime_config["timestamp"] = "%Y%m%d%H%M%S"
+            if "validate" not in self.runtime_config:
+                self.runtime_config["validate"] = False
+            if "resume" not in self.runtime_config:
+                self.runtime_config["resume"] = False
+            if "jobs" not in self.runtime_config:
+                self.runtime_config["jobs"] = os.cpu_count()
+
+        # Until the config is read, the run has a single output
+        self.runtime_configs = [self.runtime_config]
+        self.outputs = [self.runtime_config]
+
+        # Kept where they are passed in, so that one process can share them
+        # between builds (see BuildService)
+        if "file_mover" not in self.runtime_config:
+            self.runtime_config["file_mover"] = FileMover()
+        if "release_cache" not in self.runtime_config:
+            self.runtime_config["release_cache"] = SharedCache()
+        if "asset_cache" not in self.runtime_config:
+            self.runtime_config["asset_cache"] = SharedCache()
+
+        # Validation only reads the config file, so it must not need a key,
+        # root or any scratch space on disk. Nor does a signer which has its
+        # own key.
+        if self.runtime_config["validate"] or self.runtime_config.get("signer") is not None:
+            return
 
-        basedir = tempfile.TemporaryDirectory().name
+        self.parse_pgp_privatekey()
+
+        self.runtime_config["privatekey"] = self.private_key_content
+
+    def create_workspace(self):
+        # Unless a workspace root is configured, the scratch directories sit
+        # next to the output path, so that finished packages can be renamed or
+        # hardlinked into place instead of copied.
+        output_path = os.path.abspath(self.runtime_config["path"])
+        workspace_root = self.runtime_config.get("workspace")
+        if workspace_root is None or workspace_root == '':
+            workspace_root = os.path.dirname(output_path)
+        workspace_root = os.path.abspath(workspace_root)
+
+        for output in self.outputs:
+            output_path = os.path.abspath(output["path"])
+            if os.path.commonpath([workspace_root, output_path]) == output_path:
+                raise ValueError(
+                    f"Config Error: The workspace ({workspace_root}) must not be inside the output path ({output_path})")
+        output_path = os.path.abspath(self.runtime_config["path"])
+
+        basedir = os.path.join(
+            workspace_root, f".repo-to-repo-{os.path.basename(output_path)}")
+        # Held until the run ends, so that a second run against the same
+        # output (say, an overlapping cron job) cannot remove this one's
+        # workspace from under it. Kept beside the workspace, as that is removed.
+        os.makedirs(workspace_root, exist_ok=True)
+        lock_file = open(f"{basedir}.lock", 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise WorkspaceInUse(
+                f"The workspace {basedir} is in use by another run against {output_path}")
+        self.runtime_config["workspace_lock"] = lock_file
+        if os.path.exists(basedir):
+            if self.runtime_config["resume"]:
+                logging.info(f"Resuming from the workspace {basedir}")
+            else:
+                logging.debug(f"Removing stale workspace {basedir}")
+                shutil.rmtree(basedir)
         self.runtime_config["basedir"] = basedir
+        logging.debug(f"Workspace: {basedir}")
 
         workdir = os.path.join(basedir, 'workdir')
-        os.makedirs(workdir)
+        os.makedirs(workdir, exist_ok=True)
         self.runtime_config["workdir"] = workdir
 
         builddir = os.path.join(basedir, 'builddir')
-        os.makedirs(builddir)
+        os.makedirs(builddir, exist_ok=True)
         self.runtime_config["builddir"] = builddir
+        if len(self.outputs) > 1:
+            # Two outputs may each have a different package of the same name
+            for runtime_config in self.runtime_configs:
+                runtime_config["builddir"] = os.path.join(
+                    builddir, hashlib.sha1(os.path.realpath(runtime_config["path"]).encode()).hexdigest()[:12])
+                os.makedirs(runtime_config["builddir"], exist_ok=True)
 
         gnupghome = os.path.join(basedir, 'gnupghome')
-        os.makedirs(gnupghome, 0o700)
+        os.makedirs(gnupghome, 0o700, exist_ok=True)
         self.runtime_config["gnupghome"] = gnupghome
         os.environ['GNUPGHOME'] = gnupghome
 
-        self.parse_pgp_privatekey()
-
-        self.runtime_config["privatekey"] = self.private_key_content
+        self.journal = RunJournal(os.path.join(basedir, 'journal.json'))
 
     def load_pgp_privatekey(self):
-        process = subprocess.Popen(['gpg', '--import'], stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate(self.private_key_content)
-
-        if process.returncode == 0:
-            logging.debug("Import successful")
-            logging.debug(stdout)
-        else:
-            logging.error(stderr)
-            raise PGPLoadError("Unable to import the GPG key")
-
-        result = subprocess.run(
-            ['gpg', '--list-secret-keys', '--keyid-format', 'LONG'], capture_output=True, text=True)
-        output_lines = result.stdout.split('\n')
-
-        for line in output_lines:
-            re_key_id = re.search(r"^\s*([A-F0-9]{40})\s*$", line)
-            re_uid = re.search(r"^uid\s+\[[^\]]+\]\s+(.*)$", line)
-
-            if re_key_id:
-                self.runtime_config["privatekey_id"] = re_key_id.group(1)
-
-            if re_uid:
-                self.runtime_config["privatekey_uid"] = re_uid.group(1)
+        signer = GpgSigner(self.runtime_config.get("gnupghome"))
+        signer.import_key(self.private_key_content)
+        self.runtime_config["signer"] = signer
+        self.runtime_config["privatekey_id"] = signer.key_id
+        self.runtime_config["privatekey_uid"] = signer.uid
 
     def cleanUp(self):
         if "basedir" in self.runtime_config:
             shutil.rmtree(self.runtime_config["basedir"])
+        if "workspace_lock" in self.runtime_config:
+            self.runtime_config.pop("workspace_lock").close()
 
     def parse_pgp_privatekey(self):
         self.private_key_content = os.environ.get('pgp_key_base64') or None
         if self.private_key_content is not None:
             logging.debug("PGP Private Key loaded from environment variable.")
-            logging.debug(
-                f"PGP Private Key content:\n{self.private_key_content}")
             self.private_key_content = base64.b64decode(
                 str(self.private_key_content)).decode() or self.private_key_content
         elif self.pgp_privatekey_filename is None and os.environ.get('pgp_key') is not None:
@@ -103,15 +241,11 @@ class Configuration:
                 f"PGP Private Key Filename: {self.pgp_privatekey_filename}")
             with open(self.pgp_privatekey_filename, "r") as file:
                 self.private_key_content = file.read()
-            logging.debug(
-                f"PGP Private Key content:\n{self.private_key_content}")
         elif self.pgp_privatekey_filename is not None:
             logging.debug(
                 f"PGP Private Key Filename: {self.pgp_privatekey_filename}")
             with open(self.pgp_privatekey_filename, "r") as file:
                 self.private_key_content = file.read()
-            logging.debug(
-                f"PGP Private Key content:\n{self.private_key_content}")
         if self.private_key_content is None or self.private_key_content == '':
             raise PGPLoadError("No private key content supplied.")
         if (
@@ -122,288 +256,236 @@ class Configuration:
                 "-----END PGP PRIVATE KEY BLOCK-----\n")
         ):
             raise PGPLoadError(
-                f"Invalid private key content. Got: {self.private_key_content}")
-
-    def get_targets(self):
-        if self.config_file is None:
-            raise NoConfigurationFileFound("No configuration file found.")
-        logging.debug(f"Configuration file: {self.config_file}")
-        config = []
-        with open(self.config_file, "r") as file:
-            for line in file:
-                config.append(line.split("//")[0].strip())
-        self.configuration = "\n".join(config)
-        logging.debug(f"Configuration File content:\n{self.configuration}")
-
-        config: dict = json.loads(self.configuration)
-        logging.debug(f"Parsed configuration file into {config}")
-
-        if "path" in config:
-            self.runtime_config["path"] = config["path"]
+                "Invalid private key content. Expected an ASCII armored PGP private key block.")
+
+    def _expandMatrix(self, this_repo: dict) -> list:
+        # Each target with a matrix (its own, or the repo's) becomes one target
+        # per combination of the matrix values, e.g.
+        # "matrix": {"architecture": ["amd64", "arm64"]}
+        expanded = []
+        # A repo without any targets is a target of its own
+        for target in this_repo.get("targets") or [{}]:
+            matrix = target.get("matrix", this_repo.get("matrix"))
+            if matrix is None or len(matrix) == 0:
+                expanded.append((target, {}))
+                continue
+            if not isinstance(matrix, dict) or not all(isinstance(values, list) and len(values) > 0 for values in matrix.values()):
+                raise ValueError(
+                    f"Config Error: matrix must map each field name to a list of values. Repo values: {this_repo}")
+            fields = list(matrix)
+            for values in itertools.product(*[matrix[field] for field in fields]):
+                combination = dict(target)
+                combination.pop("matrix", None)
+                combination.update(zip(fields, values))
+                expanded.append((combination, dict(zip(fields, values))))
+        return expanded
+
+    def _addTarget(self, target: dict, runtime_config: dict):
+        # With split_binaries, each of the binaries is packaged on its own (all
+        # from the one download of the asset), named after the binary unless
+        # package_name says otherwise, e.g. "package_name": "tool-{binary}"
+        if target["split_binaries"] and len(target["binaries"]) > 0:
+            for binary in target["binaries"]:
+                if any(character in binary for character in "*?["):
+                    raise ValueError(
+                        f"Config Error: split_binaries needs file names rather than glob patterns in binaries, got '{binary}'")
+                package_name = target["package_name"]
+                if "{binary}" in package_name:
+                    package_name = package_name.replace("{binary}", binary)
+                else:
+                    package_name = re.sub(r'[^a-z0-9.+-]+', '-', binary.lower())
+                self._addVersions(
+                    dict(target, binaries=[binary], package_name=package_name, split_binaries=False), runtime_config)
         else:
-            raise NoTargetPathDefined("Config Error: No target path specified")
+            self._addVersions(target, runtime_config)
+
+    def _addVersions(self, target: dict, runtime_config: dict):
+        # keep_versions asks for the newest N matching releases. Each older
+        # version is a target of its own, so that it is downloaded and built
+        # alongside the rest.
+        newest = TargetRelease(
+            dict(target, version_index=0), runtime_config)
+        self.targets.append(newest)
+        for version_index in range(1, newest.result["keep_versions"]):
+            self.targets.append(TargetRelease(
+                dict(target, version_index=version_index), runtime_config))
+
+    def get_targets(self, config: dict = None):
+        # The config is read from the config files, unless it is passed in
+        # already parsed (see BuildService)
+        if config is None and len(self.config_files) == 0:
+            raise NoConfigurationFileFound("No configuration file found.")
 
+        # One timestamp for every output of the run
         if self.runtime_config["clean"]:
             self.runtime_config["pathmode"] = None
         else:
             self.runtime_config["pathmode"] = datetime.now().strftime(
                 self.runtime_config["timestamp"])
 
-        self.runtime_config["headers"]: dict = {}
-        if "headers" in config:
-            self.runtime_config["headers"] = config['headers']
-        if os.environ.get('GITHUB_TOKEN') is not None and os.environ.get('GITHUB_TOKEN') != '':
-            self.runtime_config["headers"].update(
-                {"Authorization": os.environ.get('GITHUB_TOKEN')})
-
-        default_architecture = "amd64"
-        if "architecture" in config:
-            default_architecture = config["architecture"]
+        self.targets = []
+        # The settings of each config, and the first of these for each
+        # output path, which the configs writing to that path share
+        self.runtime_configs = []
+        self.outputs = []
+        if config is not None:
+            # Defaults are filled in to the repos, so leave the caller's alone
+            self._loadConfig(copy.deepcopy(config), self.runtime_config)
+        elif len(self.config_files) == 1:
+            self._loadConfig(self._readConfig(
+                self.config_files[0]), self.runtime_config)
         else:
+            for config_file in self.config_files:
+                # Each config's own settings, over those of the whole run
+                self._loadConfig(self._readConfig(
+                    config_file), ChainMap({}, self.runtime_config))
+            self.runtime_config["path"] = self.outputs[0]["path"]
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Built list of targets: {self.targets}")
+
+    def _readConfig(self, config_file: str) -> dict:
+        logging.debug(f"Configuration file: {config_file}")
+        with open(config_file, "r") as file:
+            self.configuration = strip_comments(file.read())
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
             logging.debug(
-                "No default architecture specified in the configuration file; default: amd64")
+                f"Configuration File content:\n{redact_secrets(self.configuration)}")
+        return json.loads(self.configuration)
+
+    def _addOutput(self, runtime_config: dict):
+        self.runtime_configs.append(runtime_config)
+        output_path = os.path.realpath(runtime_config["path"])
+        for output in self.outputs:
+            existing_path = os.path.realpath(output["path"])
+            if existing_path == output_path:
+                logging.debug(
+                    f"Several configs write to {runtime_config['path']}, so their packages are published together")
+                return
+            if os.path.commonpath([existing_path, output_path]) in [existing_path, output_path]:
+                raise ValueError(
+                    f"Config Error: The output paths {output['path']} and {runtime_config['path']} must not be inside one another")
+        self.outputs.append(runtime_config)
 
-        default_formats = ["deb", "rpm"]
-        if "formats" in config:
-            default_formats = config["formats"]
-        else:
+    def _loadConfig(self, config: dict, runtime_config: dict):
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
             logging.debug(
-                "No default formats specified in the configuration file; default: ['deb', 'rpm']")
+                f"Parsed configuration file into {redact_secrets(str(config))}")
 
-        default_suite = "misc"
-        if "suite" in config:
-            default_suite = config["suite"]
+        if "path" in config:
+            runtime_config["path"] = config["path"]
         else:
-            logging.debug(
-                "No default suite specified in the configuration file; default: misc")
+            raise NoTargetPathDefined("Config Error: No target path specified")
+        self._addOutput(runtime_config)
 
-        default_archive = "main"
-        if "archive" in config:
-            default_archive = config["archive"]
-        else:
-            logging.debug(
-                "No default archive specified in the configuration file; default: main")
+        if "workspace" in config and "workspace" not in self.runtime_config:
+            self.runtime_config["workspace"] = config["workspace"]
 
-        default_homepage = ""
-        if "homepage" in config:
-            default_homepage = config["homepage"]
-        else:
-            logging.debug(
-                "No default homepage specified in the configuration file; default: None")
+        # How many targets each stage works on at once, for the whole run
+        # (--jobs for any stage left out)
+        if "stage_jobs" in config and "stage_jobs" not in self.runtime_config:
+            if not isinstance(config["stage_jobs"], dict):
+                raise ValueError(
+                    f"Config Error: stage_jobs must map stage names to a number of targets, got {config['stage_jobs']}")
+            for stage, jobs in config["stage_jobs"].items():
+                if stage not in PIPELINE_STAGES.values():
+                    raise ValueError(
+                        f"Config Error: stage_jobs has an invalid stage {stage}. Expected one of: {', '.join(PIPELINE_STAGES.values())}")
+                if not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 1:
+                    raise ValueError(
+                        f"Config Error: stage_jobs for {stage} must be a whole number of at least 1, got {jobs}")
+            self.runtime_config["stage_jobs"] = config["stage_jobs"]
 
-        default_maintainer = ""
-        if "maintainer" in config:
-            default_maintainer = config["maintainer"]
-        else:
-            logging.debug(
-                "No default maintainer specified in the configuration file; default: None")
+        runtime_config["headers"]: dict = {}
+        if "headers" in config:
+            runtime_config["headers"] = config['headers']
+        if os.environ.get('GITHUB_TOKEN') is not None and os.environ.get('GITHUB_TOKEN') != '':
+            runtime_config["headers"].update(
+                {"Authorization": os.environ.get('GITHUB_TOKEN')})
 
-        default_description = ""
-        if "description" in config:
-            default_description = config["description"]
-        else:
-            logging.debug(
-                "No default description specified in the configuration file; default: None")
+        runtime_config["mirrors"] = {}
+        if "mirrors" in config:
+            if not isinstance(config["mirrors"], dict):
+                raise ValueError(
+                    f"Config Error: mirrors must map each URL prefix to the prefix of its mirror, got {config['mirrors']}")
+            runtime_config["mirrors"] = config["mirrors"]
 
-        default_priority = "optional"
-        if "priority" in config:
-            default_priority = config["priority"]
-        else:
-            logging.debug(
-                "No default priority specified in the configuration file; default: None")
+        runtime_config["pdiff_history"] = 14
+        if "pdiff_history" in config:
+            if not isinstance(config["pdiff_history"], int) or isinstance(config["pdiff_history"], bool) or config["pdiff_history"] < 0:
+                raise ValueError(
+                    f"Config Error: pdiff_history must be a whole number (0 to turn pdiffs off), got {config['pdiff_history']}")
+            runtime_config["pdiff_history"] = config["pdiff_history"]
 
-        self.targets = []
+        runtime_config["rpm_zchunk"] = False
+        if "rpm_zchunk" in config:
+            if not isinstance(config["rpm_zchunk"], bool):
+                raise ValueError(
+                    f"Config Error: rpm_zchunk must be true or false, got {config['rpm_zchunk']}")
+            runtime_config["rpm_zchunk"] = config["rpm_zchunk"]
 
-        if "repos" not in config:
-            config["repos"] = []
+        runtime_config["rpm_deltas"] = 0
+        if "rpm_deltas" in config:
+            if not isinstance(config["rpm_deltas"], int) or isinstance(config["rpm_deltas"], bool) or config["rpm_deltas"] < 0:
+                raise ValueError(
+                    f"Config Error: rpm_deltas must be a whole number (0 to turn delta RPMs off), got {config['rpm_deltas']}")
+            runtime_config["rpm_deltas"] = config["rpm_deltas"]
+
+        defaults = {}
+        for field, default, top_level, _ in TARGET_FIELDS:
+            if top_level and field in config:
+                defaults[field] = config[field]
+            else:
+                defaults[field] = default
+                if top_level and debug:
+                    logging.debug(
+                        f"No default {field} specified in the configuration file; default: {default}")
 
-        if len(config["repos"]) == 0:
+        if "repos" not in config or len(config["repos"]) == 0:
             raise ConfigErrorNoRepositories("No repositories specified.")
 
         for this_repo in config["repos"]:
+            self._addRepo(this_repo, defaults, runtime_config)
 
-            if "platform" not in this_repo:
-                this_repo["platform"] = "github"
-            repo_platform = this_repo["platform"]
-
-            if "owner" not in this_repo:
+    def _addRepo(self, this_repo: dict, defaults: dict, runtime_config: dict):
+        for field in ["owner", "repo"]:
+            if field not in this_repo:
                 raise ValueError(
-                    f"Config Error: Failure parsing repo - missing owner field. Repo values: {this_repo}")
-            repo_owner = this_repo["owner"]
-
-            if "repo" not in this_repo:
+                    f"Config Error: Failure parsing repo - missing {field} field. Repo values: {this_repo}")
+        for field, default in defaults.items():
+            if field not in this_repo:
+                # Copied, so that no two repos share a list or dict
+                if isinstance(default, (list, dict)):
+                    default = copy.copy(default)
+                this_repo[field] = default
+        for field, fallback in REPO_FALLBACKS.items():
+            if this_repo[field] == '':
+                this_repo[field] = fallback(this_repo)
+
+        repo_values = {field: this_repo[field] for field in REPO_FIELDS}
+        for target, matrix_values in self._expandMatrix(this_repo):
+            values = dict(repo_values)
+            for field in TARGET_OVERRIDES.intersection(target):
+                values[field] = target[field]
+            object_regex = target.get("object_regex", this_repo["target_binary"])
+
+            debian_architecture, redhat_architecture = map_architecture(
+                values["architecture"])
+            placeholders = {
+                "arch": values["architecture"],
+                "deb_arch": debian_architecture,
+                "rpm_arch": redhat_architecture
+            }
+            placeholders.update(matrix_values)
+            if "{" in object_regex:
+                for placeholder, value in placeholders.items():
+                    object_regex = object_regex.replace(
+                        f"{{{placeholder}}}", str(value))
+            values["object_regex"] = object_regex
+
+            if this_repo["target_binary"] == '' and len(values["binaries"]) == 0 and not (object_regex.endswith('.deb') or object_regex.endswith('.rpm')):
                 raise ValueError(
-                    f"Config Error: Failure parsing repo - missing repo field. Repo values: {this_repo}")
-            repo_repo = this_repo["repo"]
-
-            if "target_binary" not in this_repo:
-                this_repo["target_binary"] = ""
-            repo_target_binary = this_repo["target_binary"]
-
-            if "architecture" not in this_repo:
-                this_repo["architecture"] = default_architecture
-            repo_architecture = this_repo["architecture"]
-
-            if "formats" not in this_repo:
-                this_repo["formats"] = default_formats
-            repo_formats = this_repo["formats"]
-
-            if "version_match" not in this_repo:
-                this_repo["version_match"] = ""
-            repo_version_match = this_repo["version_match"]
-
-            if "autocomplete" not in this_repo:
-                this_repo["autocomplete"] = {}
-            repo_autocomplete = this_repo["autocomplete"]
-
-            if "suite" not in this_repo:
-                this_repo["suite"] = default_suite
-            repo_suite = this_repo["suite"]
-
-            if "archive" not in this_repo:
-                this_repo["archive"] = default_archive
-            repo_archive = this_repo["archive"]
-
-            if "homepage" not in this_repo:
-                this_repo["homepage"] = default_homepage
-            if this_repo["homepage"] == '':
-                this_repo["homepage"] = f"https://github.com/{this_repo['owner']}/{this_repo['repo']}"
-            repo_homepage = this_repo["homepage"]
-
-            if "maintainer" not in this_repo:
-                this_repo["maintainer"] = default_maintainer
-            if this_repo["maintainer"] == '':
-                this_repo["maintainer"] = f"{this_repo['owner']} <{this_repo['owner']}@users.noreply.github.com>"
-            repo_maintainer = this_repo["maintainer"]
-
-            if "description" not in this_repo:
-                this_repo["description"] = default_description
-            if this_repo["description"] == '':
-                this_repo[
-                    "description"] = f"A repo-to-repo package of a release at https://github.com/{this_repo['owner']}/{this_repo['repo']}"
-            repo_description = this_repo["description"]
-
-            if "priority" not in this_repo:
-                this_repo["priority"] = default_priority
-            repo_priority = this_repo["priority"]
-
-            if "debian_dependencies" not in this_repo:
-                this_repo["debian_dependencies"] = ""
-            repo_debian_dependencies = this_repo["debian_dependencies"]
-
-            if "redhat_dependencies" not in this_repo:
-                this_repo["redhat_dependencies"] = ""
-            repo_redhat_dependencies = this_repo["redhat_dependencies"]
-
-            if "targets" not in this_repo:
-                if repo_target_binary == '':
-                    raise ValueError(
-                        f"Config Error: Failure parsing repo - missing target_binary field. Repo values: {this_repo}"
-                    )
-                else:
-                    self.targets.append(
-                        TargetRelease(
-                            {
-                                "owner": repo_owner,
-                                "repo": repo_repo,
-                                "target_binary": repo_target_binary,
-                                "autocomplete": repo_autocomplete,
-                                "suite": repo_suite,
-                                "archive": repo_archive,
-                                "formats": repo_formats,
-                                "homepage": repo_homepage,
-                                "maintainer": repo_maintainer,
-                                "description": repo_description,
-                                "priority": repo_priority,
-                                "architecture": repo_architecture,
-                                "debian_dependencies": repo_debian_dependencies,
-                                "redhat_dependencies": repo_redhat_dependencies,
-                                "version_match": repo_version_match,
-                                "object_regex": repo_target_binary,
-                                "platform": repo_platform
-                            },
-                            self.runtime_config
-                        )
-                    )
-            else:
-                for target in this_repo["targets"]:
-                    if "object_regex" not in target:
-                        target_object_regex = repo_target_binary
-                    else:
-                        target_object_regex = target["object_regex"]
-
-                    if "formats" not in target:
-                        target_formats = repo_formats
-                    else:
-                        target_formats = target["formats"]
-
-                    if "architecture" not in target:
-                        target_architecture = repo_architecture
-                    else:
-                        target_architecture = target["architecture"]
-
-                    if "version_match" not in target:
-                        target_version_match = repo_version_match
-                    else:
-                        target_version_match = target["version_match"]
-
-                    if "homepage" not in target:
-                        target_homepage = repo_homepage
-                    else:
-                        target_homepage = target["homepage"]
-
-                    if "maintainer" not in target:
-                        target_maintainer = repo_maintainer
-                    else:
-                        target_maintainer = target["maintainer"]
-
-                    if "description" not in target:
-                        target_description = repo_description
-                    else:
-                        target_description = target["description"]
-
-                    if "priority" not in target:
-                        target_priority = repo_priority
-                    else:
-                        target_priority = target["priority"]
-
-                    if "debian_dependencies" not in target:
-                        target_debian_dependencies = repo_debian_dependencies
-                    else:
-                        target_debian_dependencies = target["debian_dependencies"]
-
-                    if "redhat_dependencies" not in target:
-                        target_redhat_dependencies = repo_redhat_dependencies
-                    else:
-                        target_redhat_dependencies = target["redhat_dependencies"]
-
-                    if repo_target_binary == '' and not (target_object_regex.endswith('.deb') or target_object_regex.endswith('.rpm')):
-                        raise ValueError(
-                            f"Config Error: Failure parsing repo - missing target_binary field. Repo values: {this_repo}"
-                        )
-                    else:
-                        self.targets.append(
-                            TargetRelease(
-                                {
-                                    "owner": repo_owner,
-                                    "repo": repo_repo,
-                                    "target_binary": repo_target_binary,
-                                    "autocomplete": repo_autocomplete,
-                                    "suite": repo_suite,
-                                    "archive": repo_archive,
-                                    "formats": target_formats,
-                                    "homepage": target_homepage,
-                                    "maintainer": target_maintainer,
-                                    "description": target_description,
-                                    "priority": target_priority,
-                                    "architecture": target_architecture,
-                                    "debian_dependencies": target_debian_dependencies,
-                                    "redhat_dependencies": target_redhat_dependencies,
-                                    "version_match": target_version_match,
-                                    "object_regex": target_object_regex,
-                                    "platform": repo_platform
-                                },
-                                self.runtime_config
-                            )
-                        )
-        logging.debug(f"Built list of targets: {self.targets}")
+                    f"Config Error: Failure parsing repo - missing target_binary field. Repo values: {this_repo}"
+                )
+            self._addTarget(values, runtime_config)
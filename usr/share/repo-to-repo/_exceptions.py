@@ -26,4 +26,7 @@ class ConfigErrorNoRepositories(ValueError):
     pass
 
 class NotRoot(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class WorkspaceInUse(Exception):
+    pass
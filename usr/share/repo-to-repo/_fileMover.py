@@ -0,0 +1,128 @@
+import ctypes
+import fcntl
+import logging
+import os
+import shutil
+import threading
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# From linux/fcntl.h and linux/fs.h, for renameat2
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+class FileMover:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_linked = 0
+        self.bytes_linked = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+
+    def move(self, src: str, dst: str):
+        # Try (in order) a rename, a hardlink, a reflink and finally a full
+        # copy. Only the last of these rewrites the file content.
+        size = os.path.getsize(src)
+
+        try:
+            os.rename(src, dst)
+            self._linked(size)
+            return
+        except OSError as e:
+            logging.debug(f"Unable to rename {src} to {dst}: {e}")
+
+        try:
+            tmp_dst = f"{dst}.tmp-link"
+            os.link(src, tmp_dst)
+            os.replace(tmp_dst, dst)
+            os.remove(src)
+            self._linked(size)
+            return
+        except OSError as e:
+            logging.debug(f"Unable to hardlink {src} to {dst}: {e}")
+
+        try:
+            self._reflink(src, dst)
+            os.remove(src)
+            self._linked(size)
+            return
+        except OSError as e:
+            logging.debug(f"Unable to reflink {src} to {dst}: {e}")
+
+        shutil.copy2(src, dst)
+        os.remove(src)
+        self._copied(size)
+
+    def link(self, src: str, dst: str):
+        # As move, but src is left in place
+        size = os.path.getsize(src)
+
+        try:
+            tmp_dst = f"{dst}.tmp-link"
+            os.link(src, tmp_dst)
+            os.replace(tmp_dst, dst)
+            self._linked(size)
+            return
+        except OSError as e:
+            logging.debug(f"Unable to hardlink {src} to {dst}: {e}")
+
+        try:
+            self._reflink(src, dst)
+            self._linked(size)
+            return
+        except OSError as e:
+            logging.debug(f"Unable to reflink {src} to {dst}: {e}")
+
+        shutil.copy2(src, dst)
+        self._copied(size)
+
+    def exchange(self, src: str, dst: str):
+        # Swaps src and dst (files or directories) in one step, so anything
+        # reading dst sees either all of the old one or all of the new one.
+        # Afterwards src holds what was in dst. Where renameat2 is not
+        # available, dst is moved aside and src renamed in its place.
+        if not os.path.lexists(dst):
+            os.rename(src, dst)
+            return
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_EXCHANGE) == 0:
+                return
+            logging.debug(
+                f"Unable to exchange {src} and {dst}: {os.strerror(ctypes.get_errno())}")
+        except AttributeError as e:
+            logging.debug(f"Unable to exchange {src} and {dst}: {e}")
+
+        aside = f"{src}.tmp-exchange"
+        os.rename(dst, aside)
+        os.rename(src, dst)
+        os.rename(aside, src)
+
+    def _reflink(self, src: str, dst: str):
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dst_file.close()
+                os.remove(dst)
+                raise
+        shutil.copystat(src, dst)
+
+    def _linked(self, size: int):
+        with self.lock:
+            self.files_linked += 1
+            self.bytes_linked += size
+
+    def _copied(self, size: int):
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_copied += size
+
+    def report(self) -> str:
+        return (
+            f"Moved {self.files_linked + self.files_copied} file(s): "
+            f"{self.bytes_linked} bytes linked in {self.files_linked} file(s), "
+            f"{self.bytes_copied} bytes copied in {self.files_copied} file(s)"
+        )
@@ -1,49 +1,286 @@
-import bz2
-import gzip
+import filecmp
 import hashlib
+import json
 import logging
 import os
 import shutil
 
 from datetime import datetime, timezone
-import subprocess
 
-from _targetRelease import TargetRelease
+from _profiler import run_command
+from _signer import GpgSigner
+from _targetRelease import PACKAGE_KINDS, TargetRelease
+
+# Where the new indexes of an output updated in place are written, before
+# they are swapped in
+STAGING_DIR = ".staging"
+# Lists the pool files of each target in an output (by target_id), so that a
+# target which fails in a later run can keep the packages it has
+PUBLISHED_FILE = "published.json"
+# The Date of a Release file, as RFC 2822 in UTC
+RELEASE_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S %z'
+
+
+def output_path(runtime_config: dict) -> str:
+    # Where the packages and indexes of this run go: the output itself, or
+    # the new snapshot in it
+    if runtime_config["pathmode"] is None:
+        return runtime_config["path"]
+    return os.path.join(runtime_config["path"], runtime_config["pathmode"])
+
+
+def place_package(package_file: str, pool_file: str, runtime_config: dict) -> bool:
+    # Moves a package into the pool, unless the pool already holds the same
+    # bytes (a reused package, or one rebuilt reproducibly from the same
+    # release), which are then left untouched. Returns whether the pool changed.
+    if os.path.exists(pool_file) and (
+        os.path.samefile(package_file, pool_file) or
+        filecmp.cmp(package_file, pool_file, shallow=False)
+    ):
+        os.remove(package_file)
+        return False
+    if os.path.exists(pool_file) and runtime_config.get("index_path") is not None:
+        # The live indexes list the bytes in the pool, so new ones of the
+        # same name wait in the staging directory, and are renamed into the
+        # pool when the new indexes are swapped in
+        staged_file = staged_path(pool_file, runtime_config)
+        os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+        runtime_config["file_mover"].move(package_file, staged_file)
+        runtime_config["replaced_files"][pool_file] = staged_file
+        return True
+    runtime_config["file_mover"].move(package_file, pool_file)
+    return True
+
+
+def pool_files(target: TargetRelease, package_format: str) -> list:
+    # The pool files of every package of the format which the target has,
+    # including those carried forward from the last run (see carry_forward)
+    return [target.result[f"{kind}_pool_file"] for kind in PACKAGE_KINDS
+            if PACKAGE_KINDS[kind] == package_format and f"{kind}_pool_file" in target.result] + [
+        pool_file for pool_file in target.result.get("carried_pool_files", [])
+        if pool_file.endswith(f".{package_format}")]
+
+
+def staged_path(pool_file: str, runtime_config: dict) -> str:
+    # Where a pool file is in the staging directory
+    return os.path.join(runtime_config["index_path"], os.path.relpath(pool_file, output_path(runtime_config)))
+
+
+def stage_pool_file(pool_file: str, runtime_config: dict):
+    # For an output updated in place, links a pool file into the staging
+    # directory at the same relative path, so the indexers never see the
+    # packages which are about to be removed. One being replaced is there
+    # already (see place_package).
+    if runtime_config.get("index_path") is None or pool_file in runtime_config.get("replaced_files", {}):
+        return
+    staged_file = staged_path(pool_file, runtime_config)
+    os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+    runtime_config["file_mover"].link(pool_file, staged_file)
+
+
+def add_to_pool(target: TargetRelease, runtime_config: dict):
+    # Moves the packages of a target into the pool, as soon as it is built
+    # and ahead of the indexing, and stages each of them (see
+    # stage_pool_file). Packages already moved are left alone.
+    target_path = output_path(runtime_config)
+
+    for kind, package_format in PACKAGE_KINDS.items():
+        package_file = target.result.get(f"{kind}_package")
+        if package_file is None or not os.path.exists(package_file):
+            continue
+        if package_format == 'deb':
+            pool_dir = os.path.join(target_path, 'deb', 'pool', target.result['suite'], target.result['archive'])
+        else:
+            pool_dir = os.path.join(target_path, 'rpm')
+        os.makedirs(pool_dir, exist_ok=True)
+        pool_file = os.path.join(pool_dir, target.result[f"{kind}_package_filename"])
+        target.result[f"{kind}_pool_file"] = pool_file
+
+        if place_package(package_file, pool_file, runtime_config):
+            runtime_config["changed_files"].add(pool_file)
+        stage_pool_file(pool_file, runtime_config)
+
+
+def carry_forward(target: TargetRelease, runtime_config: dict, claimed: set) -> bool:
+    # A target which failed in this run keeps the packages it had in the last
+    # one, in the pool and in the indexes, rather than being dropped from the
+    # repository because of one bad download. claimed is the relative paths
+    # of the pool files of the targets built in this run. Returns whether
+    # there was anything to keep.
+    previous_path = runtime_config.get("previous_path")
+    if previous_path is None:
+        return False
+    published = runtime_config.get("previous_published")
+    if published is not None:
+        relative_paths = published.get(target.target_id, {"pool_files": []})
+        if isinstance(relative_paths, dict):
+            relative_paths = relative_paths["pool_files"]
+    else:
+        # An output from before PUBLISHED_FILE does not say which packages
+        # were this target's, so it keeps every one in its part of the pool
+        # which no target built in this run has
+        relative_paths = []
+        if 'deb' in target.result['formats']:
+            pool_dir = os.path.join('deb', 'pool', target.result['suite'], target.result['archive'])
+            if os.path.isdir(os.path.join(previous_path, pool_dir)):
+                relative_paths += [os.path.join(pool_dir, filename) for filename in sorted(
+                    os.listdir(os.path.join(previous_path, pool_dir))) if filename.endswith('.deb')]
+        if 'rpm' in target.result['formats'] and os.path.isdir(os.path.join(previous_path, 'rpm')):
+            relative_paths += [os.path.join('rpm', filename) for filename in sorted(
+                os.listdir(os.path.join(previous_path, 'rpm'))) if filename.endswith('.rpm')]
+        relative_paths = [relative_path for relative_path in relative_paths if relative_path not in claimed]
+
+    # Whatever the failed run left of a package is not published
+    for kind in PACKAGE_KINDS:
+        target.result.pop(f"{kind}_package", None)
+        target.result.pop(f"{kind}_pool_file", None)
+    target.result["carried_pool_files"] = []
+    target_path = output_path(runtime_config)
+    for relative_path in relative_paths:
+        previous_file = os.path.join(previous_path, relative_path)
+        if not os.path.isfile(previous_file):
+            continue
+        pool_file = os.path.join(target_path, relative_path)
+        if not os.path.exists(pool_file):
+            # Into the new snapshot, as _reusePublished does for older versions
+            os.makedirs(os.path.dirname(pool_file), exist_ok=True)
+            runtime_config["file_mover"].link(previous_file, pool_file)
+        stage_pool_file(pool_file, runtime_config)
+        target.result["carried_pool_files"].append(pool_file)
+    if len(target.result["carried_pool_files"]) == 0:
+        return False
+    logging.warning(
+        f"{target.result['owner']}/{target.result['repo']} ({target.target_id}) failed, so the packages it had are published again: {', '.join(target.result['carried_pool_files'])}")
+    return True
+
 
 class MakeRepository:
-    def __init__(self, runtime_config):
+    # formats are those of every target of the output, built or not
+    def __init__(self, runtime_config, formats=None):
         self.runtime_config = runtime_config
+        self.formats = set(formats or [])
+        self.runtime_config["previous_path"] = None
+        self.runtime_config["previous_published"] = None
+        self.runtime_config["index_path"] = None
+        self.runtime_config["changed_files"] = set()
+        self.runtime_config["stale_files"] = []
+        # Pool file -> the new bytes for it in the staging directory
+        self.runtime_config["replaced_files"] = {}
         if self.runtime_config["pathmode"] is None:
-            if os.path.exists(self.runtime_config["path"]):
-                shutil.rmtree(self.runtime_config["path"])
-
-    def finalize(self):
-        if self.runtime_config["pathmode"] is not None:
-            if os.path.exists(
-                os.path.join(
-                    self.runtime_config["path"],
-                    "latest"
-                )
-            ):
-                os.remove(
-                    os.path.join(
-                        self.runtime_config["path"],
-                        "latest"
-                    )
-                )
-
-            os.symlink(
-                src=self.runtime_config["pathmode"],
-                dst=os.path.join(
-                    self.runtime_config["path"],
-                    "latest"
-                )
-            )
+            # The output is updated in place. New packages are added to the
+            # pool beside the ones still being served, the new indexes are
+            # written to a staging directory and swapped in at the end, and
+            # only then are the packages they no longer list removed.
+            if os.path.isdir(self.runtime_config["path"]):
+                # The indexes still in place are what the new ones are diffed against
+                self.runtime_config["previous_path"] = self.runtime_config["path"]
+            staging_path = os.path.join(self.runtime_config["path"], STAGING_DIR)
+            if os.path.exists(staging_path):
+                # Left by a run which failed part way through
+                shutil.rmtree(staging_path)
+            os.makedirs(staging_path)
+            self.runtime_config["index_path"] = staging_path
+        elif os.path.isdir(os.path.join(self.runtime_config["path"], "latest")):
+            self.runtime_config["previous_path"] = os.path.realpath(
+                os.path.join(self.runtime_config["path"], "latest"))
+
+        if self.runtime_config["previous_path"] is not None:
+            published_file = os.path.join(self.runtime_config["previous_path"], PUBLISHED_FILE)
+            if os.path.exists(published_file):
+                with open(published_file, 'r') as file:
+                    self.runtime_config["previous_published"] = json.load(file)
+
+    def _writePublished(self, targets: list, published_file: str):
+        target_path = output_path(self.runtime_config)
+        published = {}
+        for target in targets:
+            # The config the packages were built from, so that an older
+            # version kept by keep_versions is rebuilt when it changes
+            published[target.target_id] = {"package_config": target.package_config, "pool_files": []}
+            for package_format in ["deb", "rpm"]:
+                published[target.target_id]["pool_files"].extend(
+                    os.path.relpath(pool_file, target_path) for pool_file in pool_files(target, package_format))
+        with open(f"{published_file}.tmp", 'w') as file:
+            json.dump(published, file, indent=2, sort_keys=True)
+        os.replace(f"{published_file}.tmp", published_file)
+
+    def _swapIndexes(self):
+        path = self.runtime_config["path"]
+        staging_path = self.runtime_config["index_path"]
+        stale_dirs = []
+        for package_format, index_dirs in [("deb", ["dists"]), ("rpm", ["repodata", "drpms"])]:
+            if not os.path.isdir(os.path.join(staging_path, package_format)):
+                # Only removed once no target is configured to publish this
+                # format, rather than whenever none of them was staged
+                if package_format not in self.formats and os.path.isdir(os.path.join(path, package_format)):
+                    stale_dirs.append(os.path.join(path, package_format))
+                continue
+            for index_dir in index_dirs:
+                staged_dir = os.path.join(staging_path, package_format, index_dir)
+                if os.path.isdir(staged_dir):
+                    logging.debug(f"Swapping in {os.path.join(path, package_format, index_dir)}")
+                    self.runtime_config["file_mover"].exchange(
+                        staged_dir, os.path.join(path, package_format, index_dir))
+        os.replace(os.path.join(staging_path, PUBLISHED_FILE), os.path.join(path, PUBLISHED_FILE))
+
+        # Only the new indexes list these bytes
+        for pool_file, staged_file in self.runtime_config["replaced_files"].items():
+            logging.debug(f"Replacing {pool_file}")
+            os.replace(staged_file, pool_file)
+
+        # No index lists these any more
+        for stale_file in self.runtime_config["stale_files"]:
+            logging.debug(f"Removing {stale_file}")
+            os.remove(stale_file)
+        pool_root = os.path.join(path, "deb", "pool")
+        for pool_dir, _, _ in os.walk(pool_root, topdown=False):
+            if pool_dir != pool_root and len(os.listdir(pool_dir)) == 0:
+                os.rmdir(pool_dir)
+        for stale_dir in stale_dirs:
+            shutil.rmtree(stale_dir)
+        shutil.rmtree(staging_path)
+        if len(self.runtime_config["stale_files"]) > 0:
+            logging.info(
+                f"Removed {len(self.runtime_config['stale_files'])} package(s) no longer published from {path}")
+
+    def finalize(self, targets: list = None):
+        # targets are those with packages in the output, built or carried forward
+        if self.runtime_config["pathmode"] is None:
+            self._writePublished(targets or [], os.path.join(self.runtime_config["index_path"], PUBLISHED_FILE))
+            self._swapIndexes()
+        else:
+            self._writePublished(targets or [], os.path.join(output_path(self.runtime_config), PUBLISHED_FILE))
+            # The new link is made beside "latest" and renamed over it, so
+            # "latest" always points at a complete snapshot
+            latest = os.path.join(self.runtime_config["path"], "latest")
+            if os.path.lexists(f"{latest}.tmp"):
+                # Left by a run which failed part way through
+                os.remove(f"{latest}.tmp")
+            os.symlink(src=self.runtime_config["pathmode"], dst=f"{latest}.tmp")
+            os.replace(f"{latest}.tmp", latest)
 
 class MakeDebRepository:
     def __init__(self, targets, runtime_config):
+        import bz2
+        import gzip
+
+        if runtime_config["pathmode"] is None:
+            target_path = runtime_config["path"]
+        else:
+            target_path = os.path.join(
+                runtime_config["path"],
+                runtime_config["pathmode"]
+            )
+        # Where the indexes are written: the staging directory of an output
+        # updated in place, or else the new snapshot itself
+        index_path = runtime_config.get("index_path") or target_path
+        staged = index_path != target_path
+
         target: TargetRelease = None
         suites_and_archives = {}
+        # (suite, archive) -> the architectures of the packages added to or
+        # removed from its pool, None when that is not known
+        changes = {}
         for target in targets:
             asset = target.result
             if asset['suite'] not in suites_and_archives:
@@ -53,145 +290,341 @@ class MakeDebRepository:
             if asset['debian_architecture'] not in suites_and_archives[asset['suite']][asset['archive']]:
                 suites_and_archives[asset['suite']][asset['archive']].append(asset['debian_architecture'])
 
-            if runtime_config["pathmode"] is None:
-                target_path = runtime_config["path"]
-            else:
-                target_path = os.path.join(
-                    runtime_config["path"],
-                    runtime_config["pathmode"]
-                )
-
-            pool_dir = os.path.join(
-                target_path,
-                'deb',
-                'pool',
-                asset['suite'],
-                asset['archive']
-            )
-            if not os.path.exists(pool_dir):
-                os.makedirs(pool_dir)
+            add_to_pool(target, runtime_config)
+            if any(pool_file in runtime_config["changed_files"] for pool_file in pool_files(target, 'deb')):
+                changes.setdefault((asset['suite'], asset['archive']), set()).add(asset['debian_architecture'])
 
-            os.rename(target.result['deb_package'], os.path.join(pool_dir, target.result['deb_package_filename']))
+        if staged:
+            # Whatever else is in the pool is no longer published
+            pool_root = os.path.join(target_path, 'deb', 'pool')
+            published = set(pool_file for target in targets for pool_file in pool_files(target, 'deb'))
+            for root, _, list_of_files in os.walk(pool_root):
+                for pool_file in list_of_files:
+                    pool_file = os.path.join(root, pool_file)
+                    if pool_file in published:
+                        continue
+                    runtime_config["stale_files"].append(pool_file)
+                    suite_and_archive = tuple(os.path.relpath(root, pool_root).split(os.sep)[:2])
+                    changes.setdefault(suite_and_archive, set()).add(self._architecture(pool_file))
 
         for suite in suites_and_archives:
+            if staged and self._reuse_suite(suite, suites_and_archives[suite], changes, target_path, index_path):
+                continue
+
             arch_list = []
             for archive in suites_and_archives[suite]:
                 for architecture in suites_and_archives[suite][archive]:
                     if architecture not in arch_list:
                         arch_list.append(architecture)
-                    result = subprocess.run(
-                        ['dpkg-scanpackages', '--arch', architecture, os.path.join("pool", suite, archive)],
-                        capture_output=True, text=True, cwd=os.path.join(target_path, "deb")
+                    index_dir = os.path.join(
+                        index_path,
+                        'deb',
+                        'dists',
+                        suite,
+                        archive,
+                        f"binary-{architecture}"
+                    )
+                    if staged and not self._changed(changes, suite, archive, architecture):
+                        published_dir = os.path.join(target_path, os.path.relpath(index_dir, index_path))
+                        if os.path.exists(os.path.join(published_dir, "Packages")):
+                            # Nothing this index lists has changed
+                            logging.debug(f"Keeping {published_dir}")
+                            shutil.copytree(published_dir, index_dir, copy_function=os.link)
+                            continue
+
+                    # --multiversion lists every version in the pool (see keep_versions),
+                    # not only the newest one of each package
+                    result = run_command(
+                        ['dpkg-scanpackages', '--multiversion', '--arch', architecture, os.path.join("pool", suite, archive)],
+                        text=True, cwd=os.path.join(index_path, "deb")
                     )
                     content = result.stdout
-                    logging.debug(f'In {os.path.join(target_path, "deb")}, running the command {" ".join(result.args)}')
+                    logging.debug(f'In {os.path.join(index_path, "deb")}, running the command {" ".join(result.args)}')
                     logging.debug(f'Return Code: {result.returncode}')
                     logging.debug(f'stderr: {result.stderr}')
                     logging.debug(f'stdout: {result.stdout}')
                     if len(content) > 0:
-                        index_dir = os.path.join(
-                            target_path,
-                            'deb',
-                            'dists',
-                            suite,
-                            archive,
-                            f"binary-{architecture}"
-                        )
                         packages_file = os.path.join(index_dir, "Packages")
                         if not os.path.exists(index_dir):
                             os.makedirs(index_dir)
                         with open(packages_file, 'w') as file:
                             file.write(content)
-                        with gzip.open(f'{packages_file}.gz', 'wb', compresslevel=9) as file:
-                            file.write(content.encode())
+                        with open(f'{packages_file}.gz', 'wb') as packages_gz:
+                            # mtime=0, so the same index always compresses to the same bytes
+                            with gzip.GzipFile(fileobj=packages_gz, mode='wb', compresslevel=9, mtime=0) as file:
+                                file.write(content.encode())
                         with bz2.open(f'{packages_file}.bz2', 'wb', compresslevel=9) as file:
                             file.write(content.encode())
 
+                        if runtime_config.get("previous_path") is not None and runtime_config.get("pdiff_history", 14) > 0:
+                            self._write_pdiffs(
+                                packages_file,
+                                os.path.join(runtime_config["previous_path"], os.path.relpath(
+                                    packages_file, index_path)),
+                                runtime_config
+                            )
+
             content = [
                 f"Suite: {suite}",
                 f"Codename: {suite}",
                 f"Architectures: {' '.join(arch_list)}",
                 f"Components: {' '.join(suites_and_archives[suite])}",
                  "Description: A repo-to-repo built collection of packages",
-                f"Date: {datetime.now(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S %z')}",
+                f"Date: {self._release_date(targets, suite, runtime_config).strftime(RELEASE_DATE_FORMAT)}",
             ]
             hash_types = {"MD5Sum": "md5", "SHA1": "sha1", "SHA256": "sha256", "SHA512": "sha512"}
             for key in hash_types:
                 content.append(f'{key}:')
-                for root, _, list_of_files in os.walk(os.path.join(target_path, "deb", "dists", suite)):
+                for root, _, list_of_files in os.walk(os.path.join(index_path, "deb", "dists", suite)):
                     for hashable_file in list_of_files:
                         if not hashable_file.endswith("Release"):
                             file_path = os.path.join(root, hashable_file)
-                            file_path_label = file_path.replace(f'{os.path.join(target_path, "deb", "dists", suite)}/', "")
+                            file_path_label = file_path.replace(f'{os.path.join(index_path, "deb", "dists", suite)}/', "")
                             with open(file_path, 'rb') as f:
                                 file_content = f.read()
                                 hash_value = hashlib.new(hash_types[key], file_content).hexdigest()
                                 file_size = os.path.getsize(file_path)
                                 content.append(f" {hash_value} {file_size} {file_path_label}")
 
-            with open(os.path.join(target_path, "deb", "dists", suite, "Release"), 'w') as file:
+            with open(os.path.join(index_path, "deb", "dists", suite, "Release"), 'w') as file:
                 for line in content:
                     file.write(f"{line}\n")
             
             self._sign_file(
-                os.path.join(target_path, "deb", "dists", suite, "Release"),
-                os.path.join(target_path, "deb", "dists", suite, "Release.gpg")
+                os.path.join(index_path, "deb", "dists", suite, "Release"),
+                os.path.join(index_path, "deb", "dists", suite, "Release.gpg"),
+                runtime_config
             )
             
             self._sign_file(
-                os.path.join(target_path, "deb", "dists", suite, "Release"),
-                os.path.join(target_path, "deb", "dists", suite, "InRelease"),
+                os.path.join(index_path, "deb", "dists", suite, "Release"),
+                os.path.join(index_path, "deb", "dists", suite, "InRelease"),
+                runtime_config,
                 clearsign=True
             )
 
-    def _sign_file(self, input_file, output_file, clearsign=False):
-        command = ['gpg', '--detach-sign', '--armor', '--sign']
-        
-        if clearsign:
-            command.append('--clearsign')
-        
-        with open(input_file, 'rb') as input_data, open(output_file, 'wb') as output_data:
-            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output_data)
-            process.communicate(input_data.read())
+    def _architecture(self, pool_file):
+        # From a pool file named name_version_architecture.deb, or None for
+        # one which is not (as a prebuilt package may be)
+        parts = os.path.basename(pool_file)[:-len(".deb")].split('_')
+        if not pool_file.endswith(".deb") or len(parts) != 3:
+            return None
+        return parts[2]
+
+    def _changed(self, changes, suite, archive, architecture):
+        # Whether the index of this architecture lists any package added to or
+        # removed from the pool. Architecture "all" packages are in them all.
+        architectures = changes.get((suite, archive), set())
+        return None in architectures or "all" in architectures or architecture in architectures
+
+    def _reuse_suite(self, suite, archives, changes, target_path, index_path):
+        # A suite in which no index has changed keeps its Release (and the
+        # signatures of it) too, as long as it has the same indexes as before
+        published_dir = os.path.join(target_path, "deb", "dists", suite)
+        if not os.path.exists(os.path.join(published_dir, "InRelease")):
+            return False
+        wanted = set()
+        for archive, architectures in archives.items():
+            for architecture in architectures:
+                if self._changed(changes, suite, archive, architecture):
+                    return False
+                wanted.add((archive, f"binary-{architecture}"))
+        published = set()
+        for archive in os.listdir(published_dir):
+            if os.path.isdir(os.path.join(published_dir, archive)):
+                published.update((archive, index_dir) for index_dir in os.listdir(os.path.join(published_dir, archive)))
+        if published != wanted:
+            return False
+        logging.debug(f"Keeping {published_dir}")
+        shutil.copytree(published_dir, os.path.join(index_path, "deb", "dists", suite), copy_function=os.link)
+        return True
+
+    def _release_date(self, targets, suite, runtime_config):
+        # The newest package in the suite dates the Release file, so the same
+        # packages always give the same Release. It never goes back before the
+        # Date of the last Release (say, when the newest package is removed),
+        # as apt may take an older one for a replay of an old Release.
+        dates = [target.result['source_date_epoch'] for target in targets
+                 if target.result['suite'] == suite and target.result.get('source_date_epoch') is not None]
+        if len(dates) == 0:
+            date = datetime.now(timezone.utc)
+        else:
+            date = datetime.fromtimestamp(max(dates), timezone.utc)
+
+        if runtime_config.get("previous_path") is not None:
+            previous_release = os.path.join(runtime_config["previous_path"], "deb", "dists", suite, "Release")
+            if os.path.exists(previous_release):
+                with open(previous_release, 'r') as file:
+                    for line in file:
+                        if line.startswith("Date:"):
+                            try:
+                                date = max(date, datetime.strptime(line[len("Date:"):].strip(), RELEASE_DATE_FORMAT))
+                            except ValueError:
+                                logging.debug(f"Unable to read the Date of {previous_release}: {line.strip()}")
+                            break
+        return date
+
+    def _write_pdiffs(self, packages_file, previous_packages_file, runtime_config):
+        # Packages.diff holds ed scripts from each of the last pdiff_history
+        # versions of Packages to the one after it, so apt can fetch a small
+        # patch instead of the whole index. Index lists them, oldest first.
+        import gzip
+
+        if not os.path.exists(previous_packages_file):
+            return
+        diff_dir = f"{packages_file}.diff"
+        previous_diff_dir = f"{previous_packages_file}.diff"
+        os.makedirs(diff_dir, exist_ok=True)
+
+        history = []
+        previous_index = os.path.join(previous_diff_dir, "Index")
+        if os.path.exists(previous_index):
+            history = self._read_pdiff_index(previous_index)
+
+        with open(packages_file, 'rb') as file:
+            current = file.read()
+        with open(previous_packages_file, 'rb') as file:
+            previous = file.read()
+
+        if previous != current:
+            result = run_command(['diff', '--ed', previous_packages_file, packages_file])
+            if result.returncode > 1:
+                logging.error(f"Diffing {previous_packages_file} and {packages_file} failed")
+                logging.error(f"stderr: {result.stderr}")
+                raise Exception("Repository failure")
+            patch = result.stdout
+            patch_name = datetime.now(timezone.utc).strftime('%Y-%m-%d-%H%M.%S')
+            with open(os.path.join(diff_dir, f"{patch_name}.gz"), 'wb') as file:
+                # mtime=0, so the same patch always compresses to the same bytes
+                with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=9, mtime=0) as patch_file:
+                    patch_file.write(patch)
+            history.append({
+                "name": patch_name,
+                "history": (hashlib.sha256(previous).hexdigest(), len(previous)),
+                "patch": (hashlib.sha256(patch).hexdigest(), len(patch))
+            })
+
+        kept = []
+        for entry in history[-runtime_config.get("pdiff_history", 14):]:
+            patch_file = os.path.join(diff_dir, f"{entry['name']}.gz")
+            if not os.path.exists(patch_file):
+                previous_patch_file = os.path.join(previous_diff_dir, f"{entry['name']}.gz")
+                if not os.path.exists(previous_patch_file):
+                    # A missing patch breaks the chain, so nothing before it is usable
+                    kept = []
+                    continue
+                runtime_config["file_mover"].link(previous_patch_file, patch_file)
+            kept.append(entry)
+        history = kept
+
+        if len(history) == 0:
+            shutil.rmtree(diff_dir)
+            return
+
+        content = [f"SHA256-Current: {hashlib.sha256(current).hexdigest()} {len(current)}"]
+        content.append("SHA256-History:")
+        for entry in history:
+            content.append(f" {entry['history'][0]} {entry['history'][1]:>7} {entry['name']}")
+        content.append("SHA256-Patches:")
+        for entry in history:
+            content.append(f" {entry['patch'][0]} {entry['patch'][1]:>7} {entry['name']}")
+        content.append("SHA256-Download:")
+        for entry in history:
+            patch_file = os.path.join(diff_dir, f"{entry['name']}.gz")
+            with open(patch_file, 'rb') as file:
+                download_hash = hashlib.sha256(file.read()).hexdigest()
+            content.append(f" {download_hash} {os.path.getsize(patch_file):>7} {entry['name']}.gz")
+        with open(os.path.join(diff_dir, "Index"), 'w') as file:
+            for line in content:
+                file.write(f"{line}\n")
+
+    def _read_pdiff_index(self, index_file):
+        entries = {}
+        section = None
+        with open(index_file, 'r') as file:
+            for line in file:
+                if not line.startswith(' '):
+                    section = line.split(':')[0].strip()
+                    continue
+                digest, size, name = line.split()
+                if section not in ["SHA256-History", "SHA256-Patches"]:
+                    continue
+                if name not in entries:
+                    entries[name] = {"name": name}
+                entries[name]["history" if section == "SHA256-History" else "patch"] = (digest, int(size))
+        return [entry for entry in entries.values() if "history" in entry and "patch" in entry]
+
+    def _sign_file(self, input_file, output_file, runtime_config, clearsign=False):
+        signer = runtime_config.get("signer") or GpgSigner()
+        signer.sign(input_file, output_file, clearsign=clearsign)
 
 class MakeRPMRepository:
     def __init__(self, targets, runtime_config):
+        if runtime_config["pathmode"] is None:
+            target_path = os.path.join(runtime_config["path"], "rpm")
+        else:
+            target_path = os.path.join(
+                runtime_config["path"],
+                runtime_config["pathmode"],
+                "rpm"
+            )
+        # Where the metadata is written: the staging directory of an output
+        # updated in place, or else the new snapshot itself
+        index_path = target_path
+        if runtime_config.get("index_path") is not None:
+            index_path = os.path.join(runtime_config["index_path"], "rpm")
+            os.makedirs(index_path, exist_ok=True)
+
         target: TargetRelease = None
+        changed = False
         for target in targets:
-            if runtime_config["pathmode"] is None:
-                target_path = os.path.join(runtime_config["path"], "rpm")
-            else:
-                target_path = os.path.join(
-                    runtime_config["path"],
-                    runtime_config["pathmode"],
-                    "rpm"
-                )
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-            os.rename(target.result['rpm_package'], os.path.join(target_path, target.result['rpm_package_filename']))
-
-        cmd = 'createrepo_c .'
-        logging.debug(f"Executing command: {cmd}")
-        with subprocess.Popen(cmd, cwd=target_path, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-            exit_code = process.wait()
-            stdout = process.stdout.read().decode('utf-8')
-            stderr = process.stderr.read().decode('utf-8')
-            if exit_code > 0:
-                logging.error(f"Signature {self.result['rpm_package']} failed")
-                logging.error(f"stdout: {stdout}")
-                logging.error(f"stderr: {stderr}")
-                raise Exception("Signature failure")
-
-        cmd = 'gpg --detach-sign --armor repodata/repomd.xml'
-        logging.debug(f"Executing command: {cmd}")
-        with subprocess.Popen(cmd, cwd=target_path, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-            exit_code = process.wait()
-            stdout = process.stdout.read().decode('utf-8')
-            stderr = process.stderr.read().decode('utf-8')
-            if exit_code > 0:
-                logging.error(f"Signature {self.result['rpm_package']} failed")
-                logging.error(f"stdout: {stdout}")
-                logging.error(f"stderr: {stderr}")
-                raise Exception("Signature failure")
-
-        pass
+            add_to_pool(target, runtime_config)
+            if any(pool_file in runtime_config["changed_files"] for pool_file in pool_files(target, 'rpm')):
+                changed = True
+
+        if index_path != target_path:
+            # Whatever else is in the pool is no longer published
+            published = set(pool_file for target in targets for pool_file in pool_files(target, 'rpm'))
+            stale_files = [os.path.join(target_path, filename) for filename in sorted(os.listdir(target_path))
+                           if filename.endswith('.rpm') and os.path.join(target_path, filename) not in published]
+            runtime_config["stale_files"] += stale_files
+            if not changed and len(stale_files) == 0 and os.path.exists(os.path.join(target_path, "repodata", "repomd.xml")):
+                logging.info(f"No RPM package in {target_path} has changed, so its metadata is kept")
+                return
+
+        process = run_command(self._createrepo_command(index_path, runtime_config), cwd=index_path, text=True)
+        if process.returncode > 0:
+            logging.error(f"Creating the RPM repository in {index_path} failed")
+            logging.error(f"stdout: {process.stdout}")
+            logging.error(f"stderr: {process.stderr}")
+            raise Exception("Repository failure")
+
+        signer = runtime_config.get("signer") or GpgSigner()
+        signer.sign(os.path.join(index_path, "repodata", "repomd.xml"),
+                    os.path.join(index_path, "repodata", "repomd.xml.asc"))
+
+    def _createrepo_command(self, target_path, runtime_config):
+        command = ['createrepo_c']
+        if runtime_config.get("rpm_zchunk", False):
+            # Lets dnf fetch only the chunks of the metadata which changed
+            command.append('--zck')
+
+        previous_path = runtime_config.get("previous_path")
+        if previous_path is not None:
+            previous_path = os.path.join(previous_path, "rpm")
+            if not os.path.exists(os.path.join(previous_path, "repodata", "repomd.xml")):
+                previous_path = None
+        if previous_path is not None:
+            # Reuse the metadata of the packages which have not changed
+            command += ['--update', '--update-md-path', previous_path]
+
+        if runtime_config.get("rpm_deltas", 0) > 0:
+            # Deltas from up to rpm_deltas older versions, whether they are
+            # still in this repository (see keep_versions) or were in the last one
+            command += ['--deltas', '--num-deltas', str(runtime_config["rpm_deltas"]),
+                        '--oldpackagedirs', target_path]
+            if previous_path is not None:
+                command += ['--oldpackagedirs', previous_path]
+
+        command.append('.')
+        return command
@@ -0,0 +1,208 @@
+import io
+import logging
+import struct
+
+from _profiler import run_command
+
+# The first request reads this much, which is usually enough for the whole of
+# a .deb's control.tar or an .rpm's headers.
+PROBE_BLOCK_SIZE = 64 * 1024
+
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+RPM_TAGS = {1000: "name", 1001: "version",
+            1002: "release", 1003: "epoch", 1022: "architecture"}
+# The OpenPGP signatures of the main header in the signature header
+RPM_SIGNATURE_TAGS = [267, 268]  # DSAHEADER, RSAHEADER
+
+
+class RangeReader:
+    # Reads byte ranges through read_range(start, length), which may be an
+    # HTTP Range request, fetching at least a block at a time.
+    def __init__(self, read_range, block_size: int = PROBE_BLOCK_SIZE):
+        self.read_range = read_range
+        self.block_size = block_size
+        self.start = 0
+        self.buffer = b''
+        self.requests = 0
+
+    def read(self, start: int, length: int) -> bytes:
+        if start < self.start or start + length > self.start + len(self.buffer):
+            self.requests += 1
+            self.buffer = self.read_range(start, max(length, self.block_size))
+            self.start = start
+            if self.buffer is None:
+                raise ValueError("Byte ranges are not available")
+        data = self.buffer[start - self.start:start - self.start + length]
+        if len(data) != length:
+            raise ValueError(
+                f"Expected {length} bytes at offset {start}, got {len(data)}")
+        return data
+
+
+def file_range(file_path: str):
+    def read_range(start: int, length: int) -> bytes:
+        with open(file_path, 'rb') as file:
+            file.seek(start)
+            return file.read(length)
+    return read_range
+
+
+def _parseControl(content: str) -> dict:
+    fields = {}
+    field = None
+    for line in content.splitlines():
+        if line.startswith((' ', '\t')) and field is not None:
+            fields[field] += f"\n{line}"
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            fields[field] = value.strip()
+    return fields
+
+
+def probe_deb(reader: RangeReader) -> dict:
+    # A .deb is an ar archive of debian-binary, control.tar.* and data.tar.*,
+    # so only the first two members need to be read.
+    import gzip
+    import lzma
+    import tarfile
+
+    if reader.read(0, 8) != b"!<arch>\n":
+        raise ValueError("Not a Debian package")
+    offset = 8
+    for _ in range(3):
+        header = reader.read(offset, 60)
+        name = header[0:16].decode().strip().rstrip('/')
+        size = int(header[48:58].decode().strip())
+        offset += 60
+        if name.startswith('control.tar'):
+            data = reader.read(offset, size)
+            break
+        offset += size + (size % 2)
+    else:
+        raise ValueError("No control.tar found in the Debian package")
+
+    if name.endswith('.gz'):
+        data = gzip.decompress(data)
+    elif name.endswith('.xz'):
+        data = lzma.decompress(data)
+    elif name.endswith('.zst'):
+        result = run_command(['zstd', '--decompress', '--stdout'], input=data)
+        if result.returncode != 0:
+            raise ValueError(
+                f"Unable to decompress {name}: {result.stderr.decode().strip()}")
+        data = result.stdout
+    elif name != 'control.tar':
+        raise ValueError(f"Unknown compression of {name}")
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        for member in tar.getmembers():
+            if member.name in ['control', './control']:
+                fields = _parseControl(
+                    tar.extractfile(member).read().decode())
+                break
+        else:
+            raise ValueError("No control file found in the Debian package")
+
+    return {
+        "format": "deb",
+        "name": fields.get("Package"),
+        "version": fields.get("Version"),
+        "architecture": fields.get("Architecture"),
+        "fields": fields
+    }
+
+
+def _rpmHeader(reader: RangeReader, offset: int) -> tuple:
+    # Returns the (index entries, data store, size) of the header at offset
+    if reader.read(offset, 4) != RPM_HEADER_MAGIC:
+        raise ValueError(f"No RPM header found at offset {offset}")
+    entries, store_size = struct.unpack('>II', reader.read(offset + 8, 8))
+    index = reader.read(offset + 16, entries * 16)
+    store = reader.read(offset + 16 + entries * 16, store_size)
+    return index, store, 16 + entries * 16 + store_size
+
+
+def probe_rpm(reader: RangeReader) -> dict:
+    # An .rpm starts with a 96 byte lead, then the signature header (padded
+    # to 8 bytes) and the main header, which holds the name and version.
+    if reader.read(0, 4) != RPM_LEAD_MAGIC:
+        raise ValueError("Not an RPM package")
+    _, _, signature_size = _rpmHeader(reader, 96)
+    offset = 96 + signature_size + (-signature_size % 8)
+    index, store, _ = _rpmHeader(reader, offset)
+
+    tags = {}
+    for entry in range(len(index) // 16):
+        tag, tag_type, data_offset, _ = struct.unpack(
+            '>IIII', index[entry * 16:entry * 16 + 16])
+        if tag not in RPM_TAGS:
+            continue
+        if tag_type in [6, 8, 9]:  # STRING, STRING_ARRAY, I18NSTRING
+            tags[RPM_TAGS[tag]] = store[data_offset:store.index(
+                b'\0', data_offset)].decode()
+        elif tag_type == 4:  # INT32
+            tags[RPM_TAGS[tag]] = struct.unpack(
+                '>I', store[data_offset:data_offset + 4])[0]
+
+    version = f"{tags.get('version')}-{tags.get('release')}"
+    if tags.get('epoch') is not None:
+        version = f"{tags['epoch']}:{version}"
+    return {
+        "format": "rpm",
+        "name": tags.get("name"),
+        "version": version,
+        "architecture": tags.get("architecture"),
+        "fields": tags
+    }
+
+
+def rpm_signed_content(file_path: str) -> dict:
+    # Signing an .rpm only changes its signature header, so the digest of
+    # everything after it (the main header and the payload) is the same for
+    # the package signed or not. Returns that digest, and the OpenPGP
+    # signatures in the signature header.
+    import hashlib
+
+    reader = RangeReader(file_range(file_path))
+    if reader.read(0, 4) != RPM_LEAD_MAGIC:
+        raise ValueError(f"{file_path} is not an RPM package")
+    index, store, signature_size = _rpmHeader(reader, 96)
+    signatures = []
+    for entry in range(len(index) // 16):
+        tag, tag_type, data_offset, count = struct.unpack(
+            '>IIII', index[entry * 16:entry * 16 + 16])
+        if tag in RPM_SIGNATURE_TAGS and tag_type == 7:  # BIN
+            signatures.append(store[data_offset:data_offset + count])
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        file.seek(96 + signature_size + (-signature_size % 8))
+        while True:
+            chunk = file.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return {"digest": digest.hexdigest(), "signatures": signatures}
+
+
+def probe_package(name: str, read_range) -> dict:
+    # Returns the name, version and architecture of a .deb or .rpm without
+    # reading more of it than its headers, or None if that is not possible.
+    import lzma
+    import tarfile
+
+    reader = RangeReader(read_range)
+    try:
+        if name.endswith('.deb'):
+            metadata = probe_deb(reader)
+        elif name.endswith('.rpm'):
+            metadata = probe_rpm(reader)
+        else:
+            return None
+    except (ValueError, OSError, EOFError, lzma.LZMAError, tarfile.TarError, struct.error) as e:
+        logging.debug(f"Unable to probe {name}: {e}")
+        return None
+    logging.debug(
+        f"Probed {name} in {reader.requests} read(s): {metadata['name']} {metadata['version']} {metadata['architecture']}")
+    return metadata
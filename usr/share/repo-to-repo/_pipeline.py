@@ -0,0 +1,120 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+
+# The stages of TargetRelease.getRelease, and the names they go by in the
+# config (see stage_jobs). Resolving and downloading wait on the network,
+# extracting and building on the CPU, and signing on gpg.
+PIPELINE_STAGES = {
+    'resolved': 'resolve',
+    'downloaded': 'download',
+    'extracted': 'extract',
+    'built': 'build',
+    'signed': 'sign'
+}
+
+
+class Pipeline:
+    # Runs the stages of many targets at once, each stage with its own
+    # workers, so one target downloads while another builds and a third is
+    # signed. A run then takes about as long as its slowest stage rather than
+    # the sum of them. Between the stages are bounded queues, so a fast stage
+    # cannot run far ahead of a slow one (and fill the disk). The largest
+    # downloads go first.
+    def __init__(self, stage_jobs: dict, journal=None, on_finished=None):
+        self.stage_jobs = stage_jobs
+        self.journal = journal
+        self.on_finished = on_finished
+        self.queues = {}
+        for stage in PIPELINE_STAGES:
+            if stage == 'downloaded':
+                # A resolved target is only a little metadata, so every one of
+                # them can wait here, and the largest of them all goes first
+                self.queues[stage] = queue.PriorityQueue()
+            else:
+                # Room for one waiting target per worker of the stage, as
+                # each holds a download or an unpacked tree on disk
+                self.queues[stage] = queue.Queue(maxsize=stage_jobs[stage])
+        # Breaks ties between downloads of the same size, in the order they came
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.pending = 0
+        self.started = {}
+        self.seconds = {}
+
+    def _put(self, stage: str, target):
+        if stage == 'downloaded':
+            self.queues[stage].put((-target.downloadSize(), next(self.order), target))
+        else:
+            self.queues[stage].put((0, next(self.order), target))
+
+    def _finish(self, target, error: Exception = None):
+        if error is None:
+            try:
+                target.finishRelease()
+            except Exception as e:
+                error = e
+        with self.lock:
+            start = self.started.get(target.target_id, time.monotonic())
+            self.seconds[target.target_id] = round(time.monotonic() - start, 3)
+        if self.on_finished is not None:
+            try:
+                self.on_finished(target, error)
+            except Exception as e:
+                logging.error(f"Handling the end of {target.target_id} failed: {e}")
+        with self.lock:
+            self.pending -= 1
+            self.done.notify_all()
+
+    def _work(self, stage: str):
+        while True:
+            _, _, target = self.queues[stage].get()
+            if target is None:
+                return
+            with self.lock:
+                self.started.setdefault(target.target_id, time.monotonic())
+            try:
+                next_stage = target.runStage(stage, self.journal)
+                if next_stage is not None:
+                    # Waits here while the next stage is full
+                    self._put(next_stage, target)
+            except Exception as e:
+                self._finish(target, e)
+                continue
+            if next_stage is None:
+                self._finish(target)
+
+    def run(self, targets: list):
+        # Returns once every target has finished. on_finished(target, error)
+        # is called as each one does, with the exception it failed with, if any.
+        workers = []
+        for stage in PIPELINE_STAGES:
+            for _ in range(self.stage_jobs[stage]):
+                worker = threading.Thread(target=self._work, args=(stage,), daemon=True)
+                worker.start()
+                workers.append(worker)
+
+        with self.lock:
+            self.pending = len(targets)
+        for target in targets:
+            try:
+                stage = target.startRelease(self.journal)
+                if stage is not None:
+                    self._put(stage, target)
+            except Exception as e:
+                self._finish(target, e)
+                continue
+            if stage is None:
+                self._finish(target)
+
+        with self.lock:
+            while self.pending > 0:
+                self.done.wait()
+        for stage in PIPELINE_STAGES:
+            for _ in range(self.stage_jobs[stage]):
+                self.queues[stage].put((0, next(self.order), None))
+        for worker in workers:
+            worker.join()
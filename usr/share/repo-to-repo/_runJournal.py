@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import threading
+
+# The stages a target passes through, in order. Each is recorded once it has
+# completed, so a resumed run can carry on from the last one.
+STAGES = ['resolved', 'downloaded', 'extracted', 'built', 'signed', 'published']
+
+
+class RunJournal:
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(journal_file):
+            self._load()
+
+    def _load(self):
+        with open(self.journal_file, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short if the previous run was killed
+                    logging.debug(
+                        f"Ignoring an incomplete journal line in {self.journal_file}")
+                    continue
+                if record["target"] not in self.entries:
+                    self.entries[record["target"]] = {}
+                self.entries[record["target"]].update(record)
+
+    def _append(self, record: dict):
+        # One JSON record per line, so a checkpoint only ever appends to the file
+        with self.lock:
+            if record["target"] not in self.entries:
+                self.entries[record["target"]] = {}
+            self.entries[record["target"]].update(record)
+            with open(self.journal_file, 'a') as file:
+                file.write(f"{json.dumps(record)}\n")
+
+    def record(self, target, stage: str):
+        record = {
+            "target": target.target_id,
+            "stage": stage,
+            "failed_stage": None,
+            "error": None,
+            "result": target.result,
+            "package_id": getattr(target, 'package_id', None),
+            "package_path": getattr(target, 'package_path', None)
+        }
+        # The release (with its full list of assets) only changes when it is
+        # resolved, so later checkpoints leave it out.
+        if stage == 'resolved':
+            record["release"] = target.release
+        self._append(record)
+
+    def fail(self, target, stage: str, error: Exception):
+        self._append({
+            "target": target.target_id,
+            "failed_stage": stage,
+            "error": str(error)
+        })
+
+    def failures(self) -> dict:
+        return {
+            target_id: entry for target_id, entry in self.entries.items()
+            if entry.get("failed_stage") is not None
+        }
+
+    def checkpoint(self, target_id: str) -> dict:
+        entry = self.entries.get(target_id)
+        if entry is None or entry.get("stage") not in STAGES:
+            return None
+        return entry
@@ -0,0 +1,200 @@
+import email.utils
+import logging
+import mimetypes
+import os
+import re
+import threading
+import urllib.parse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _verifyRepository import VerifyRepository
+
+
+class DigestIndex:
+    # The digests the repository's own indexes hold for each file, loaded once
+    # per snapshot, for use as ETags.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+
+    def _stamp(self, root: str) -> tuple:
+        # Changes whenever any of the top level indexes are rewritten, which
+        # covers an output updated in place as well as a new snapshot
+        index_files = [root, os.path.join(root, "rpm", "repodata", "repomd.xml")]
+        dists_dir = os.path.join(root, "deb", "dists")
+        if os.path.isdir(dists_dir):
+            index_files += [os.path.join(dists_dir, suite, "Release")
+                            for suite in sorted(os.listdir(dists_dir))]
+        stamp = [root]
+        for index_file in index_files:
+            if os.path.exists(index_file):
+                stat = os.stat(index_file)
+                stamp.append((stat.st_ino, stat.st_mtime_ns))
+        return tuple(stamp)
+
+    def get(self, root: str) -> dict:
+        key = self._stamp(root)
+        with self.lock:
+            if key not in self.snapshots:
+                digests = {}
+                verifier = VerifyRepository(root)
+                for relative_path, expectations in verifier.parseIndexes().items():
+                    for _, _, hashes in expectations:
+                        for algorithm in ['sha256', 'sha512', 'sha1', 'md5']:
+                            if algorithm in hashes:
+                                digests[relative_path] = f"{algorithm}-{hashes[algorithm].lower()}"
+                                break
+                        if relative_path in digests:
+                            break
+                # Only the current snapshot is ever served
+                self.snapshots = {key: digests}
+                logging.debug(
+                    f"Loaded {len(digests)} digest(s) from the indexes in {root}")
+            return self.snapshots[key]
+
+
+class RepositoryRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as apt and dnf fetch many files over one connection
+    protocol_version = "HTTP/1.1"
+    server_version = "repo-to-repo"
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _snapshot(self) -> str:
+        # "latest" is resolved once, so the whole request is answered from
+        # one snapshot even if it is switched while the file is being sent
+        path = self.server.repository_path
+        if os.path.lexists(os.path.join(path, "latest")):
+            return os.path.realpath(os.path.join(path, "latest"))
+        if any(os.path.isdir(os.path.join(path, fmt)) for fmt in ("deb", "rpm")):
+            # An output updated in place is served from the directory itself
+            return os.path.realpath(path)
+        # A timestamped output whose first run has not finished yet: the
+        # snapshots beside "latest" are not served
+        return None
+
+    def _sendEmpty(self, status: HTTPStatus, headers: dict = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _range(self, size: int) -> tuple:
+        # Returns (start, end) for a single byte range, None for the whole
+        # file, or False if the range cannot be satisfied
+        match = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get("Range", "").strip())
+        if match is None or (match.group(1) == '' and match.group(2) == ''):
+            # Absent, malformed or several ranges: send the whole file
+            return None
+        if match.group(1) == '':
+            length = int(match.group(2))
+            if length == 0:
+                return False
+            return (max(size - length, 0), size - 1)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) != '' else size - 1
+        if start >= size or end < start:
+            return False
+        return (start, min(end, size - 1))
+
+    def _serve(self, send_body: bool):
+        root = self._snapshot()
+        if root is None:
+            self._sendEmpty(HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        request_path = urllib.parse.unquote(
+            self.path.split('?', 1)[0].split('#', 1)[0])
+        relative_path = os.path.normpath(request_path.lstrip('/'))
+        file_path = os.path.join(root, relative_path)
+        if (
+            relative_path.startswith('..') or
+            os.path.commonpath([root, os.path.realpath(file_path)]) != root or
+            not os.path.isfile(file_path)
+        ):
+            self._sendEmpty(HTTPStatus.NOT_FOUND)
+            return
+
+        with open(file_path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            digest = self.server.digests.get(root).get(relative_path)
+            if digest is None:
+                # Files outside of the indexes (Release, repomd.xml and so on)
+                # never change within a snapshot either
+                digest = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+            etag = f'"{digest}"'
+            headers = {
+                "ETag": etag,
+                "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+                "Accept-Ranges": "bytes"
+            }
+
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match is not None and (
+                if_none_match.strip() == '*' or
+                etag in [tag.strip() for tag in if_none_match.split(',')]
+            ):
+                self._sendEmpty(HTTPStatus.NOT_MODIFIED, headers)
+                return
+
+            byte_range = self._range(stat.st_size)
+            if_range = self.headers.get("If-Range")
+            if if_range is not None and if_range.strip() != etag:
+                byte_range = None
+            if byte_range is False:
+                headers["Content-Range"] = f"bytes */{stat.st_size}"
+                self._sendEmpty(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers)
+                return
+
+            if byte_range is None:
+                start, length = 0, stat.st_size
+                self.send_response(HTTPStatus.OK)
+            else:
+                start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{stat.st_size}"
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", mimetypes.guess_type(
+                file_path)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(length))
+            self.end_headers()
+
+            if send_body and length > 0:
+                # Straight from the page cache to the socket
+                self.wfile.flush()
+                self.connection.sendfile(file, start, length)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+
+class RepositoryServer(ThreadingHTTPServer):
+    # A thread per connection, and room for a whole fleet of clients to
+    # connect at once
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class ServeRepository:
+    def __init__(self, path: str, host: str = "127.0.0.1", port: int = 8080):
+        self.path = os.path.abspath(path)
+        self.server = RepositoryServer((host, port), RepositoryRequestHandler)
+        self.server.repository_path = self.path
+        self.server.digests = DigestIndex()
+
+    def serve(self):
+        host, port = self.server.server_address[:2]
+        logging.info(f"Serving {self.path} on http://{host}:{port}/")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def shutdown(self):
+        self.server.shutdown()
@@ -0,0 +1,92 @@
+import logging
+import re
+
+from _exceptions import PGPLoadError
+from _profiler import run_command
+
+
+class GpgSigner:
+    # Signs the packages and repository indexes with gpg, using the keyring in
+    # gnupghome (or $GNUPGHOME when that is not given) and the key key_id (or
+    # gpg's default key). Each signature names both, so several signers can
+    # be used side by side in one process.
+    def __init__(self, gnupghome: str = None, key_id: str = None):
+        self.gnupghome = gnupghome
+        self.key_id = key_id
+        self.uid = None
+
+    def _gpg(self) -> list:
+        command = ['gpg']
+        if self.gnupghome is not None:
+            command += ['--homedir', self.gnupghome]
+        if self.key_id is not None:
+            command += ['--local-user', self.key_id]
+        return command
+
+    def import_key(self, private_key_content: str):
+        command = ['gpg']
+        if self.gnupghome is not None:
+            command += ['--homedir', self.gnupghome]
+        result = run_command(
+            command + ['--import'], input=private_key_content, text=True)
+
+        if result.returncode == 0:
+            logging.debug("Import successful")
+            logging.debug(result.stdout)
+        else:
+            logging.error(result.stderr)
+            raise PGPLoadError("Unable to import the GPG key")
+
+        result = run_command(
+            command + ['--list-secret-keys', '--keyid-format', 'LONG'], text=True)
+        output_lines = result.stdout.split('\n')
+
+        for line in output_lines:
+            re_key_id = re.search(r"^\s*([A-F0-9]{40})\s*$", line)
+            re_uid = re.search(r"^uid\s+\[[^\]]+\]\s+(.*)$", line)
+
+            if re_key_id:
+                self.key_id = re_key_id.group(1)
+
+            if re_uid:
+                self.uid = re_uid.group(1)
+
+    def sign(self, input_file: str, output_file: str, clearsign: bool = False):
+        # An armored detached signature, or with clearsign the signed file
+        # itself (as for InRelease)
+        command = self._gpg() + ['--detach-sign', '--armor', '--sign']
+
+        if clearsign:
+            command.append('--clearsign')
+
+        with open(input_file, 'rb') as input_data, open(output_file, 'wb') as output_data:
+            process = run_command(
+                command, input=input_data.read(), stdout=output_data)
+        if process.returncode > 0:
+            logging.error(f"Signature of {input_file} failed")
+            logging.error(f"stderr: {process.stderr}")
+            raise Exception("Signature failure")
+
+    def signed_by(self, signature: bytes) -> bool:
+        # Whether an OpenPGP signature was made with this signer's key
+        if self.key_id is None:
+            return False
+        command = ['gpg']
+        if self.gnupghome is not None:
+            command += ['--homedir', self.gnupghome]
+        process = run_command(command + ['--list-packets'], input=signature)
+        key_ids = re.findall(rb"keyid ([0-9A-Fa-f]{16})", process.stdout)
+        return any(self.key_id.upper().endswith(key_id.decode().upper()) for key_id in key_ids)
+
+    def sign_rpm(self, package_file: str):
+        command = ['rpm', '--define', '%_signature gpg',
+                   '--define', f'%_gpg_name {self.key_id or ""}']
+        if self.gnupghome is not None:
+            command += ['--define', f'%_gpg_path {self.gnupghome}']
+        process = run_command(command + ['--addsign', package_file], text=True)
+        if process.returncode > 0:
+            logging.error(
+                f"Signature {package_file} failed")
+            logging.error(f"stdout: {process.stdout}")
+            logging.error(f"stderr: {process.stderr}")
+            raise Exception("Signature failure")
@@ -0,0 +1,205 @@
+import abc
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+from _exceptions import ApiNotAvailable
+
+
+class ReleaseSource(abc.ABC):
+    # Where the releases of a target come from. Releases are GitHub shaped
+    # dicts (tag_name, published_at and assets, each asset with a name), and
+    # are listed newest first, a page at a time.
+    def __init__(self, target: dict, runtime_config: dict):
+        self.target = target
+        self.config = runtime_config
+
+    def license(self) -> str:
+        return 'TBC'
+
+    @abc.abstractmethod
+    def releases(self, page: int) -> list:
+        pass
+
+    @abc.abstractmethod
+    def download(self, asset: dict, file_path: str):
+        pass
+
+    def read_range(self, asset: dict, start: int, length: int) -> bytes:
+        # Part of an asset without downloading all of it, or None where the
+        # source cannot do that
+        return None
+
+    def size(self, asset: dict) -> int:
+        # How many bytes downloading the asset takes, or 0 if that is not known
+        return asset.get('size') or 0
+
+
+class GithubSource(ReleaseSource):
+    def _rewrite(self, url: str) -> str:
+        # Send requests to a caching mirror instead, e.g.
+        # "mirrors": {"https://github.com/": "https://cache.example.org/github/"}
+        mirrors = self.config.get("mirrors") or {}
+        for prefix in sorted(mirrors, key=len, reverse=True):
+            if url.startswith(prefix):
+                return f"{mirrors[prefix]}{url[len(prefix):]}"
+        return url
+
+    def _session(self):
+        # A requests.Session (or anything with the same get()) may be passed
+        # in, so that a long running process keeps its connections open
+        session = self.config.get("session")
+        if session is None:
+            import requests
+            session = requests
+        return session
+
+    def _getData(self, api_url: str) -> json:
+        api_url = self._rewrite(api_url)
+        try:
+            logging.debug(f"Getting API {api_url}")
+            response = self._session().get(api_url, headers=self.config["headers"])
+        except:
+            raise ApiNotAvailable("Unable to load github api")
+        if response.status_code != 200:
+            raise ApiNotAvailable(
+                f"Failed to retrieve data from GitHub API Endpoint: {api_url}. Status code: {response.status_code}")
+
+        return response.json()
+
+    def license(self) -> str:
+        data = self._getData(
+            f'https://api.github.com/repos/{self.target["owner"]}/{self.target["repo"]}')
+        if (
+            'license' in data and
+            data['license'] is not None and
+            len(data['license']) > 0 and
+            'name' in data['license'] and
+            len(data['license']['name']) > 0
+        ):
+            return data['license']['name']
+        return 'TBC'
+
+    def releases(self, page: int) -> list:
+        return self._getData(
+            f'https://api.github.com/repos/{self.target["owner"]}/{self.target["repo"]}/releases?page={page}')
+
+    def download(self, asset: dict, file_path: str):
+        url = self._rewrite(asset['browser_download_url'])
+        logging.debug(f"Downloading {url}")
+        response = self._session().get(url, headers=self.config["headers"])
+        if response.status_code != 200:
+            raise FileNotFoundError(
+                f"Failed to download the file: {url}")
+        with open(file_path, 'wb') as downloadFile:
+            downloadFile.write(response.content)
+
+    def read_range(self, asset: dict, start: int, length: int) -> bytes:
+        url = self._rewrite(asset['browser_download_url'])
+        headers = dict(self.config["headers"])
+        headers["Range"] = f"bytes={start}-{start + length - 1}"
+        logging.debug(f"Reading bytes {headers['Range']} of {url}")
+        response = self._session().get(url, headers=headers, stream=True)
+        with response:
+            # Anything other than a partial response would be the whole file
+            if response.status_code != 206:
+                return None
+            return response.content
+
+
+class LocalSource(ReleaseSource):
+    # Reads the releases from <source_path>/<owner>/<repo>, for builds which
+    # cannot reach GitHub. That directory either holds a releases.json
+    # manifest (a list of releases, or {"license": ..., "releases": [...]},
+    # where each asset has a path relative to the manifest), or one directory
+    # per release, named after its tag and holding its assets.
+    def __init__(self, target: dict, runtime_config: dict):
+        super().__init__(target, runtime_config)
+        if target.get('source_path') is None or target['source_path'] == '':
+            raise ValueError(
+                f"source_path is a required value for the local platform, for {target['owner']}/{target['repo']}")
+        self.release_dir = os.path.join(
+            target['source_path'], target['owner'], target['repo'])
+        self.manifest = None
+
+    def _load(self) -> dict:
+        if self.manifest is not None:
+            return self.manifest
+
+        manifest_file = os.path.join(self.release_dir, 'releases.json')
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as file:
+                manifest = json.load(file)
+            if isinstance(manifest, list):
+                manifest = {"releases": manifest}
+            for release in manifest["releases"]:
+                for asset in release.get("assets", []):
+                    if "path" not in asset:
+                        asset["path"] = asset["name"]
+                    asset["path"] = os.path.join(self.release_dir, asset["path"])
+        elif os.path.isdir(self.release_dir):
+            manifest = {"releases": []}
+            for tag in os.listdir(self.release_dir):
+                tag_dir = os.path.join(self.release_dir, tag)
+                if not os.path.isdir(tag_dir):
+                    continue
+                modified = os.path.getmtime(tag_dir)
+                manifest["releases"].append({
+                    "tag_name": tag,
+                    "published_at": datetime.fromtimestamp(modified, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    "assets": [
+                        {"name": name, "path": os.path.join(tag_dir, name)}
+                        for name in sorted(os.listdir(tag_dir))
+                        if os.path.isfile(os.path.join(tag_dir, name))
+                    ]
+                })
+            # Newest first, like the GitHub API
+            manifest["releases"].sort(
+                key=lambda release: (release["published_at"], release["tag_name"]), reverse=True)
+        else:
+            raise FileNotFoundError(
+                f"No releases found for {self.target['owner']}/{self.target['repo']} in {self.release_dir}")
+
+        self.manifest = manifest
+        return manifest
+
+    def license(self) -> str:
+        return self._load().get("license") or 'TBC'
+
+    def releases(self, page: int) -> list:
+        # Everything is on the first page
+        if page > 1:
+            return []
+        return self._load()["releases"]
+
+    def download(self, asset: dict, file_path: str):
+        if not os.path.isfile(asset['path']):
+            raise FileNotFoundError(
+                f"Failed to find the file: {asset['path']}")
+        # Linked rather than copied where the filesystem allows it
+        self.config["file_mover"].link(asset['path'], file_path)
+
+    def read_range(self, asset: dict, start: int, length: int) -> bytes:
+        with open(asset['path'], 'rb') as file:
+            file.seek(start)
+            return file.read(length)
+
+    def size(self, asset: dict) -> int:
+        if not os.path.isfile(asset['path']):
+            return 0
+        return os.path.getsize(asset['path'])
+
+
+SOURCES = {
+    'github': GithubSource,
+    'local': LocalSource
+}
+
+
+def get_source(target: dict, runtime_config: dict) -> ReleaseSource:
+    platform = target.get('platform') or 'github'
+    if platform not in SOURCES:
+        raise ValueError(
+            f"Invalid platform defined. Got {platform}")
+    return SOURCES[platform](target, runtime_config)
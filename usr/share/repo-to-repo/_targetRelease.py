@@ -1,15 +1,102 @@
+import fnmatch
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
-import subprocess
-import tarfile
-import zipfile
+import struct
+import threading
+import time
+from datetime import datetime
 
-import requests
+from _exceptions import RepoTargetInvalidValue, RepoTargetMissingValue
+from _fileMover import FileMover
+from _packageProbe import file_range, probe_package, rpm_signed_content
+from _profiler import profiler, run_command
+from _runJournal import RunJournal, STAGES
+from _signer import GpgSigner
+from _sources import get_source
 
-from _exceptions import RepoTargetInvalidValue, RepoTargetMissingValue, GithubApiNotAvailable, ApiNotAvailable
+
+# Looked up for every target, so built once
+VALID_FORMATS = frozenset(['deb', 'rpm'])
+# Used for architecture cross-mapping
+VALID_ARCHITECTURES = frozenset([
+    # Default "any" architectures (e.g. shell scripts, interpreted scripts)
+    'noarch', 'all', 'any',
+    'x86-64', 'amd64',      # Intel/AMD architectures
+    'arm64', 'aarch64'      # ARM architectures
+])                          # Note that no other architectures are listed as neither RedHat nor Debian
+# have these releases commonly available. As always, Pull requests, welcome!
+# Used by Debian Packages
+VALID_ARCHIVES = frozenset(['main', 'contrib', 'non-free'])
+VALID_SUITES = frozenset([
+    'admin', 'cli-mono', 'comm', 'database', 'debug', 'devel', 'doc', 'editors',
+    'education', 'electronics', 'embedded', 'fonts', 'games', 'gnome', 'gnu-r', 'gnustep',
+    'graphics', 'hamradio', 'haskell', 'httpd', 'interpreters', 'introspection', 'java',
+    'javascript', 'kde', 'kernel', 'libdevel', 'libs', 'lisp', 'localization', 'mail',
+    'math', 'metapackages', 'misc', 'net', 'news', 'ocaml', 'oldlibs', 'otherosfs', 'perl',
+    'php', 'python', 'ruby', 'rust', 'science', 'shells', 'sound', 'tasks', 'tex', 'text',
+    'utils', 'vcs', 'video', 'web', 'x11', 'xfce', 'zope'
+])
+VALID_PRIORITIES = frozenset(['required', 'important',
+                              'standard', 'optional', 'extra'])
+# Compression levels accepted by dpkg-deb and rpmbuild for each compressor
+DEBIAN_COMPRESSION_LEVELS = {
+    'gzip': range(0, 10), 'xz': range(0, 10), 'zstd': range(1, 23), 'none': range(0, 1)}
+REDHAT_COMPRESSION_LEVELS = {
+    'gzip': range(1, 10), 'xz': range(0, 10), 'zstd': range(1, 20)}
+# What strip does to each ELF binary in a package: removes its debug
+# sections, or its symbol table as well
+STRIP_ARGUMENTS = {'debug': '--strip-debug', 'all': '--strip-all'}
+# The packages a target can build, by the prefix of their result keys
+# (deb_package, deb_package_filename, deb_pool_file and so on), and the format
+# of each. The _debug packages hold the debug info stripped from the binaries
+# (see debug_package), and are named as Debian and RedHat name theirs.
+PACKAGE_KINDS = {'deb': 'deb', 'rpm': 'rpm', 'deb_debug': 'deb', 'rpm_debug': 'rpm'}
+DEBUG_PACKAGE_SUFFIXES = {'deb_debug': '-dbgsym', 'rpm_debug': '-debuginfo'}
+
+
+def map_architecture(architecture: str) -> tuple:
+    # Returns the (debian, redhat) names for an architecture
+    if architecture in ['all', 'noarch', 'any']:
+        return ('all', 'noarch')
+    if architecture in ['x86_64', 'amd64', 'x86-64']:  # 64bit Intel
+        return ('amd64', 'x86_64')
+    if architecture in ['aarch64', 'arm64']:  # 64bit ARM
+        return ('arm64', 'aarch64')
+    return (architecture, architecture)
+
+
+class SharedCache:
+    # Shared between targets, so that work they have in common is done once:
+    # looking up the release of a repository for each architecture of a
+    # matrix, or downloading and extracting an asset packaged several times.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.values = {}
+
+    def get(self, key: str, fetch, valid=None):
+        # With valid, a value for which valid(value) is False (say, a path
+        # which has since been removed) is fetched again
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            key_lock = self.key_locks[key]
+        with key_lock:
+            if key in self.values and valid is not None and not valid(self.values[key]):
+                del self.values[key]
+            if key not in self.values:
+                self.values[key] = fetch()
+            return self.values[key]
+
+    def prune(self, valid):
+        # Forgets every value for which valid(value) is False
+        with self.lock:
+            for key in [key for key, value in self.values.items() if not valid(value)]:
+                del self.values[key]
 
 
 class TargetRelease:
@@ -29,59 +116,47 @@ class TargetRelease:
             self.config["privatekey"] = ""
             self.config["privatekey_id"] = ""
             self.config["privatekey_uid"] = ""
+            self.config["file_mover"] = FileMover()
+            self.config["release_cache"] = SharedCache()
+            self.config["asset_cache"] = SharedCache()
+            self.config["mirrors"] = {}
 
         self._setArchitecture()
         self._validateValues()
+        self.source = get_source(self.result, self.config)
+
+        # Stable across runs of the same config, so a resumed run can find
+        # this target in the journal of the earlier run.
+        self.target_id = f"{self.result['repo']}-{hashlib.sha1(json.dumps(self.result, sort_keys=True).encode()).hexdigest()[:12]}"
+        # The same for every version the target keeps, as keep_versions and
+        # version_index only pick the release. Published with the packages, so
+        # that an older version is only reused if it was built the same way.
+        self.package_config = hashlib.sha1(json.dumps(
+            {field: value for field, value in self.result.items() if field not in ["keep_versions", "version_index"]},
+            sort_keys=True).encode()).hexdigest()[:12]
 
     def __repr__(self) -> str:
         return json.dumps(self.result)
 
     def _setArchitecture(self):
         if "architecture" in self.result:
-            architecture = self.result["architecture"]
-            self.result["debian_architecture"] = architecture
-            self.result["redhat_architecture"] = architecture
-            if architecture in ['all', 'noarch', 'any']:
-                self.result["debian_architecture"] = 'all'
-                self.result["redhat_architecture"] = 'noarch'
-            if architecture in ['x86_64', 'amd64', 'x86-64']:  # 64bit Intel
-                self.result["debian_architecture"] = 'amd64'
-                self.result["redhat_architecture"] = 'x86_64'
-            if architecture in ['aarch64', 'arm64']:  # 64bit ARM
-                self.result["debian_architecture"] = 'arm64'
-                self.result["redhat_architecture"] = 'aarch64'
+            self.result["debian_architecture"], self.result["redhat_architecture"] = map_architecture(
+                self.result["architecture"])
 
     def _validateValues(self):
         # Variables used for other tests below
         invalid_formats = []
         unused_autocompletes = []
-        # Used for architecture cross-mapping
-        validArchitectures = [
-            # Default "any" architectures (e.g. shell scripts, interpreted scripts)
-            'noarch', 'all', 'any',
-            'x86-64', 'amd64',      # Intel/AMD architectures
-            'arm64', 'aarch64'      # ARM architectures
-        ]                           # Note that no other architectures are listed as neither RedHat nor Debian
-        # have these releases commonly available. As always, Pull requests, welcome!
-        # Used by Debian Packages
-        validArchives = ['main', 'contrib', 'non-free']
-        validSuites = [
-            'admin', 'cli-mono', 'comm', 'database', 'debug', 'devel', 'doc', 'editors',
-            'education', 'electronics', 'embedded', 'fonts', 'games', 'gnome', 'gnu-r', 'gnustep',
-            'graphics', 'hamradio', 'haskell', 'httpd', 'interpreters', 'introspection', 'java',
-            'javascript', 'kde', 'kernel', 'libdevel', 'libs', 'lisp', 'localization', 'mail',
-            'math', 'metapackages', 'misc', 'net', 'news', 'ocaml', 'oldlibs', 'otherosfs', 'perl',
-            'php', 'python', 'ruby', 'rust', 'science', 'shells', 'sound', 'tasks', 'tex', 'text',
-            'utils', 'vcs', 'video', 'web', 'x11', 'xfce', 'zope'
-        ]
-        validPriorities = ['required', 'important',
-                           'standard', 'optional', 'extra']
-
         if not isinstance(self.result['object_regex'], str):
             raise RepoTargetInvalidValue(
                 f"object_regex must be a string, got {type(self.result['object_regex'])}")
         if self.result['object_regex'] is None or self.result['object_regex'] == '':
             raise RepoTargetMissingValue("object_regex is a required value.")
+        try:
+            re.compile(self.result['object_regex'])
+        except re.error as e:
+            raise RepoTargetInvalidValue(
+                f"object_regex must be a valid regular expression, got {self.result['object_regex']!r}: {e}")
 
         if not isinstance(self.result['formats'], list):
             raise RepoTargetInvalidValue(
@@ -89,7 +164,7 @@ class TargetRelease:
         if self.result['formats'] is None or self.result['formats'] == []:
             raise RepoTargetMissingValue("formats is a required value.")
         for format in self.result['formats']:
-            if format not in ['deb', 'rpm']:
+            if format not in VALID_FORMATS:
                 invalid_formats += [format]
         if len(invalid_formats) > 0:
             raise RepoTargetInvalidValue(
@@ -100,7 +175,7 @@ class TargetRelease:
                 f"architecture must be a string, got {type(self.result['architecture'])}")
         if self.result['architecture'] is None or self.result['architecture'] == '':
             raise RepoTargetMissingValue("architecture is a required value.")
-        if not self.result['architecture'] in validArchitectures:
+        if not self.result['architecture'] in VALID_ARCHITECTURES:
             if not self.config['quiet']:
                 logging.warning(
                     f"architecture ('{self.result['architecture']}') is not, but should be, one of ('noarch' == 'all' == 'any'), ('x86-64' == 'amd64'), or ('arm64' == 'aarch64') due to architecture mapping. [Pull requests, welcome!](https://github.com/repo-to-repo/repo-to-repo)")
@@ -117,13 +192,24 @@ class TargetRelease:
         if self.result['repo'] is None or self.result['repo'] == '':
             raise RepoTargetMissingValue("repo is a required value.")
 
+        if self.result.get('package_name') is not None and not isinstance(self.result['package_name'], str):
+            raise RepoTargetInvalidValue(
+                f"package_name must be a string, got {type(self.result['package_name'])}")
+
+        binaries = self.result.get('binaries') or []
+        if not isinstance(binaries, list) or not all(isinstance(binary, str) and binary != '' for binary in binaries):
+            raise RepoTargetInvalidValue(
+                f"binaries must be a list of file names or glob patterns, got {binaries}")
+
         if not (self.result['object_regex'].endswith('.deb') or self.result['object_regex'].endswith('.rpm')):
-            if not isinstance(self.result['target_binary'], str):
-                raise RepoTargetInvalidValue(
-                    f"target_binary must be a string, got {type(self.result['target_binary'])}")
-            if self.result['target_binary'] is None or self.result['target_binary'] == '':
-                raise RepoTargetMissingValue(
-                    "target_binary is a required value.")
+            # A list of binaries replaces the single target_binary
+            if len(binaries) == 0:
+                if not isinstance(self.result['target_binary'], str):
+                    raise RepoTargetInvalidValue(
+                        f"target_binary must be a string, got {type(self.result['target_binary'])}")
+                if self.result['target_binary'] is None or self.result['target_binary'] == '':
+                    raise RepoTargetMissingValue(
+                        "target_binary is a required value.")
 
             if self.result['autocomplete'] is not None and len(self.result['autocomplete']) > 0:
                 for shell in self.result['autocomplete']:
@@ -142,7 +228,7 @@ class TargetRelease:
             if self.result['archive'] is None or self.result['archive'] == '':
                 raise RepoTargetMissingValue(
                     "archive is a required value for debian format packages.")
-            if not self.result['archive'] in validArchives:
+            if not self.result['archive'] in VALID_ARCHIVES:
                 if not self.config['quiet']:
                     logging.warning(
                         f"Archive ('{self.result['archive']}') is not, but should be, one of the valid archives from the list in the [Debian Policy](https://www.debian.org/doc/debian-policy/ch-archive.html#archive-areas). Ensure you're comfortable with this before publishing.")
@@ -153,7 +239,7 @@ class TargetRelease:
             if not isinstance(self.result['suite'], str):
                 raise RepoTargetInvalidValue(
                     f"suite must be a string, got {type(self.result['suite'])}")
-            if not self.result['suite'] in validSuites:
+            if not self.result['suite'] in VALID_SUITES:
                 if not self.config['quiet']:
                     logging.warning(
                         f"suite ('{self.result['suite']}') is not, but should be, one of the valid suites from the list in the [Debian Policy](https://www.debian.org/doc/debian-policy/ch-archive.html#s-subsections). Ensure you're comfortable with this before publishing.")
@@ -164,130 +250,337 @@ class TargetRelease:
             if not isinstance(self.result['priority'], str):
                 raise RepoTargetInvalidValue(
                     f"priority must be a string, got {type(self.result['priority'])}")
-            if not self.result['priority'] in validPriorities:
+            if not self.result['priority'] in VALID_PRIORITIES:
                 raise RepoTargetInvalidValue(
                     f"priority ('{self.result['priority']}') is not, but must be, one of the valid priority values from the list in the [Debian Policy](https://www.debian.org/doc/debian-policy/ch-archive.html#s-priorities).")
 
-        logging.debug(f"Values validated for RepoTarget: object_regex: {self.result['object_regex']} | formats: {self.result['formats']} | architecture: {self.result['architecture']} | owner: {self.result['owner']} | repo: {self.result['repo']} | target_binary: {self.result['target_binary']} | version_match: {self.result['version_match']} | autocomplete: {self.result['autocomplete']} | suite: {self.result['suite']} | archive: {self.result['archive']}")
+        keep_versions = self.result.get('keep_versions', 1)
+        if not isinstance(keep_versions, int) or isinstance(keep_versions, bool) or keep_versions < 1:
+            raise RepoTargetInvalidValue(
+                f"keep_versions must be a whole number of at least 1, got {keep_versions}")
 
-    def _getData(self, api_url: str) -> json:
-        try:
-            logging.debug(f"Getting API {api_url}")
-            response = requests.get(api_url, headers=self.config["headers"])
-        except:
-            raise ApiNotAvailable("Unable to load github api")
-        if response.status_code != 200:
-            raise ApiNotAvailable(
-                f"Failed to retrieve data from GitHub API Endpoint: {api_url}. Status code: {response.status_code}")
-
-        return response.json()
-
-    def _getReleaseData(self, page: int = 1) -> bool:
-        # TODO: Consider how to handle a non Github Repo
-        # TODO: Consider how to handle more than a single binary release, e.g. aws-cli
-        if "platform" not in self.result or self.result['platform'] == 'github':
-            if 'license' not in self.result:
-                data = self._getData(
-                    f'https://api.github.com/repos/{self.result["owner"]}/{self.result["repo"]}')
-                self.result['license'] = 'TBC'
-                if (
-                    'license' in data and
-                    len(data['license']) > 0 and
-                    'name' in data['license'] and
-                    len(data['license']['name']) > 0
-                ):
-                    self.result['license'] = data['license']['name']
-
-            data = self._getData(
-                f'https://api.github.com/repos/{self.result["owner"]}/{self.result["repo"]}/releases?page={page}')
+        for packager, compressionLevels in [('debian', DEBIAN_COMPRESSION_LEVELS), ('redhat', REDHAT_COMPRESSION_LEVELS)]:
+            compression = self.result.get(f'{packager}_compression') or ''
+            level = self.result.get(f'{packager}_compression_level')
+            if compression == '':
+                if level is not None:
+                    raise RepoTargetMissingValue(
+                        f"{packager}_compression is a required value when {packager}_compression_level is set.")
+                continue
+            if compression not in compressionLevels:
+                raise RepoTargetInvalidValue(
+                    f"{packager}_compression should be one of {list(compressionLevels)}, got '{compression}'")
+            if level is not None and (
+                not isinstance(level, int) or
+                isinstance(level, bool) or
+                level not in compressionLevels[compression]
+            ):
+                raise RepoTargetInvalidValue(
+                    f"{packager}_compression_level for {compression} should be a number from {compressionLevels[compression].start} to {compressionLevels[compression].stop - 1}, got {level}")
+
+        strip = self.result.get('strip') or ''
+        if strip != '' and strip not in STRIP_ARGUMENTS:
+            raise RepoTargetInvalidValue(
+                f"strip should be one of {list(STRIP_ARGUMENTS)}, got '{strip}'")
+        debug_package = self.result.get('debug_package', False)
+        if not isinstance(debug_package, bool):
+            raise RepoTargetInvalidValue(
+                f"debug_package must be true or false, got {debug_package}")
+        if debug_package and strip == '':
+            raise RepoTargetMissingValue(
+                "strip is a required value when debug_package is set.")
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Values validated for RepoTarget: object_regex: {self.result['object_regex']} | formats: {self.result['formats']} | architecture: {self.result['architecture']} | owner: {self.result['owner']} | repo: {self.result['repo']} | target_binary: {self.result['target_binary']} | version_match: {self.result['version_match']} | autocomplete: {self.result['autocomplete']} | suite: {self.result['suite']} | archive: {self.result['archive']}")
+
+    def _getReleaseData(self) -> bool:
+        # Every version kept of a target shares the one scan of the releases,
+        # and picks its own release from it by version_index.
+        key = json.dumps([self.result.get('platform', 'github'), self.result.get('source_path'),
+                         self.result['owner'], self.result['repo'], self.result['version_match'],
+                         self.result.get('keep_versions', 1)])
+
+        def fetch():
+            self._fetchReleaseData()
+            return (self.result['license'], self.releases)
+
+        self.result['license'], self.releases = self.config["release_cache"].get(
+            key, fetch)
+        version_index = self.result.get('version_index', 0)
+        if version_index < len(self.releases):
+            self.release = self.releases[version_index]
+        else:
+            self.release = None
+        return True
+
+    def _fetchReleaseData(self, page: int = 1) -> bool:
+        if page == 1:
+            self.releases = []
+        keep_versions = self.result.get('keep_versions', 1)
+        if 'license' not in self.result:
+            self.result['license'] = self.source.license()
+
+        data = self.source.releases(page)
+        # The releases come newest first, so the first keep_versions
+        # matches are the ones to keep
+        for entry in data:
             if self.result["version_match"] is None or self.result["version_match"] == '' or self.result["version_match"] == 'latest':
-                self.release = data[0]
-                return True
-            else:
-                for entry in data:
-                    tag = entry['tag_name']
-                    version_match = self.result["version_match"]
-                    logging.debug(
-                        f"Tag matching? {tag} == {version_match}: {tag.startswith(version_match)}")
-                    if version_match != '':
-                        if tag.startswith(self.result['version_match']):
-                            self.release = entry
-                            return True
-                    else:
-                        self.release = entry
-                        return True
-
-            if len(data) > 0:
-                return self._getReleaseData(page+1)
+                self.releases.append(entry)
             else:
-                raise RecursionError("Failed to get a release")
+                tag = entry['tag_name']
+                version_match = self.result["version_match"]
+                logging.debug(
+                    f"Tag matching? {tag} == {version_match}: {tag.startswith(version_match)}")
+                if tag.startswith(self.result['version_match']):
+                    self.releases.append(entry)
+            if len(self.releases) >= keep_versions:
+                self.release = self.releases[0]
+                return True
+
+        if len(data) > 0:
+            return self._fetchReleaseData(page+1)
+        elif len(self.releases) > 0:
+            self.release = self.releases[0]
+            return True
         else:
-            raise ValueError(
-                f"Invalid platform defined. Got {self.result['platform']}")
+            raise RecursionError("Failed to get a release")
+
+    def _selectAsset(self) -> dict:
+        for asset in self.release['assets']:
+            nameMatch = re.match(self.result.get(
+                'object_regex'), asset['name'])
+            if nameMatch:
+                self.result['name'] = asset['name']
+
+                versionSearch = re.search(
+                    r'^[^0-9]*([0-9].*)', self.release['tag_name'])
+                if versionSearch:
+                    versionNumber = versionSearch.group(1)
+                else:
+                    versionNumber = self.release['published_at']
+
+                self.result['versionNumber'] = versionNumber
+                self.result['source_date_epoch'] = self._sourceDateEpoch()
+                self.package_id = f"{self._packageName()}-{versionNumber}-{self.result['architecture']}"
+                # Targets may be built side by side, so each gets its own directories
+                self.package_path = os.path.join(
+                    self.config["workdir"], 'SOURCES', self.target_id)
+                return asset
+        raise ValueError("Did not match the asset in the object_regex")
 
     def _getAsset(self) -> bool:
-        if "platform" not in self.result or self.result['platform'] == 'github':
-            for asset in self.release['assets']:
-                nameMatch = re.match(self.result.get(
-                    'object_regex'), asset['name'])
-                if nameMatch:
-                    self.result['name'] = asset['name']
-
-                    versionSearch = re.search(
-                        r'^[^0-9]*([0-9].*)', self.release['tag_name'])
-                    if versionSearch:
-                        versionNumber = versionSearch.group(1)
-                    else:
-                        versionNumber = self.release['published_at']
-
-                    self.result['versionNumber'] = versionNumber
-                    self.package_id = f"{self.result['repo']}-{versionNumber}-{self.result['architecture']}"
-                    self.package_path = os.path.join(
-                        self.config["workdir"], 'SOURCES', self.package_id)
-
-                    with open(os.path.join(self.config["workdir"], asset['name']), 'wb') as downloadFile:
-                        response = requests.get(
-                            asset['browser_download_url'], self.config["headers"])
-                        if response.status_code == 200:
-                            downloadFile.write(response.content)
-                            self.result['file'] = downloadFile.name
-                            downloadFile.close()
-                            logging.debug(
-                                f"Written file to {downloadFile.name}")
-                        else:
-                            raise FileNotFoundError(
-                                f"Failed to download the file: {asset['browser_download_url']}")
-
-                    file_extensions = ['.tgz', '.gz', '.bz2', '.xz', '.zip']
-                    unpack_dir = os.path.join(self.config['workdir'], 'unpack')
-
-                    if any(self.result['file'].endswith(ext) for ext in file_extensions):
-                        # Unpack the file based on its extension
-                        if self.result['file'].endswith('.zip'):
-                            with zipfile.ZipFile(self.result['file'], 'r') as zip_ref:
-                                zip_ref.extractall(unpack_dir)
-                        elif self.result['file'].endswith('.tgz') or self.result['file'].endswith('.gz'):
-                            with tarfile.open(self.result['file'], 'r:gz') as tar_ref:
-                                tar_ref.extractall(unpack_dir)
-                        elif self.result['file'].endswith('.bz2'):
-                            with tarfile.open(self.result['file'], 'r:bz2') as tar_ref:
-                                tar_ref.extractall(unpack_dir)
-                        elif self.result['file'].endswith('.xz'):
-                            with tarfile.open(self.result['file'], 'r:xz') as tar_ref:
-                                tar_ref.extractall(unpack_dir)
-
-                        file_regex = self.result.get(
-                            'file_regex', f"^{self.result['target_binary']}$")
-                        for root, _, files in os.walk(unpack_dir):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                if os.path.isfile(file_path) and re.match(file_regex, file):
-                                    self.result['file'] = file_path
-                    return True
-            raise ValueError("Did not match the asset in the object_regex")
+        asset = self._selectAsset()
+        # Targets packaging the same asset (e.g. binaries split into several
+        # packages) download it once between them
+        key = json.dumps([self.result.get('platform', 'github'), self.result.get('source_path'),
+                          asset.get('browser_download_url', asset.get('path')), asset['name']])
+        download_dir = os.path.join(
+            self.config["workdir"], 'download', hashlib.sha1(key.encode()).hexdigest()[:12])
+        file_path = os.path.join(download_dir, asset['name'])
+
+        def fetch():
+            # Only a complete download is ever in file_path, so one left by an
+            # earlier run can be used as it is
+            if not os.path.exists(file_path):
+                os.makedirs(download_dir, exist_ok=True)
+                self.source.download(asset, f"{file_path}.tmp")
+                os.replace(f"{file_path}.tmp", file_path)
+                logging.debug(f"Written file to {file_path}")
+            return file_path
+
+        self.result['file'] = self.config["asset_cache"].get(key, fetch, os.path.exists)
+        return True
+
+    def _sourceDateEpoch(self) -> int:
+        # Every timestamp in the packages is set to when the release was
+        # published, so rebuilding the same release gives identical packages
+        published_at = self.release.get('published_at')
+        if published_at is None:
+            return 0
+        return int(datetime.fromisoformat(published_at.replace('Z', '+00:00')).timestamp())
+
+    def _buildEnvironment(self) -> dict:
+        return dict(os.environ, SOURCE_DATE_EPOCH=str(self.result['source_date_epoch']))
+
+    def _normaliseTree(self, directory_path: str):
+        for root, dirs, files in os.walk(directory_path):
+            for name in dirs + files:
+                os.utime(os.path.join(root, name), (self.result['source_date_epoch'],
+                         self.result['source_date_epoch']), follow_symlinks=False)
+        os.utime(directory_path, (self.result['source_date_epoch'],
+                 self.result['source_date_epoch']))
+
+    def _packageName(self, kind: str = None) -> str:
+        # The name of the kind of package given (see PACKAGE_KINDS)
+        return (self.result.get('package_name') or self.result['repo']) + DEBUG_PACKAGE_SUFFIXES.get(kind, '')
+
+    def _packageKinds(self) -> list:
+        # The kinds of package this target builds (see PACKAGE_KINDS).
+        # Prebuilt packages are published as they are.
+        kinds = list(self.result['formats'])
+        if self.result.get('debug_package') and not (self.result['name'].endswith('.deb') or self.result['name'].endswith('.rpm')):
+            kinds += [f"{package_format}_debug" for package_format in self.result['formats']]
+        return kinds
+
+    def _packageFilename(self, kind: str) -> str:
+        # Prebuilt packages keep their upstream name
+        if self.result['name'].endswith(f".{kind}"):
+            return self.result['name']
+        if PACKAGE_KINDS[kind] == 'deb':
+            return f"{self._packageName(kind)}_{self.result['versionNumber']}_{self.result['debian_architecture']}.deb"
+        return f"{self._packageName(kind)}-{self.result['versionNumber']}-1.{self.result['redhat_architecture']}.rpm"
+
+    def _debugPath(self) -> str:
+        # The tree of the debug packages, beside that of the package
+        return f"{self.package_path}.debug"
+
+    def _previousPath(self) -> str:
+        # Where the output of the last run is, if there was one
+        if self.config["pathmode"] is None:
+            previous_path = self.config["path"]
         else:
-            raise ValueError(
-                f"Invalid platform defined. Got {self.result['platform']}")
+            previous_path = os.path.join(self.config["path"], "latest")
+        if not os.path.isdir(previous_path):
+            return None
+        return previous_path
+
+    def _reusePublished(self) -> bool:
+        # A package published by an earlier run is linked from there rather
+        # than downloaded and built again. That is the case for an older
+        # version kept by keep_versions, whose release will not change, and for
+        # a prebuilt package whose headers (read with a few byte range
+        # requests) match the one in the pool. The newest version of a package
+        # we build ourselves is always rebuilt, and an older one is only
+        # reused if it was built from the same config.
+        from _makeRepositories import PUBLISHED_FILE
+
+        previous_path = self._previousPath()
+        if previous_path is None:
+            return False
+        asset = self._selectAsset()
+        prebuilt = asset['name'].endswith('.deb') or asset['name'].endswith('.rpm')
+        if self.result.get('version_index', 0) == 0 and not prebuilt:
+            return False
+
+        built_with = {}
+        if not prebuilt:
+            published_file = os.path.join(previous_path, PUBLISHED_FILE)
+            if os.path.exists(published_file):
+                with open(published_file, 'r') as file:
+                    published = json.load(file)
+                # Outputs from before package_config list the pool files alone
+                for entry in published.values():
+                    if isinstance(entry, dict):
+                        for relative_path in entry["pool_files"]:
+                            built_with[relative_path] = entry["package_config"]
+
+        pool_files = {}
+        for kind in self._packageKinds():
+            if PACKAGE_KINDS[kind] == 'deb':
+                pool_file = os.path.join(previous_path, 'deb', 'pool', self.result['suite'],
+                                         self.result['archive'], self._packageFilename(kind))
+            else:
+                pool_file = os.path.join(
+                    previous_path, 'rpm', self._packageFilename(kind))
+            if not os.path.isfile(pool_file):
+                return False
+            if not prebuilt and built_with.get(os.path.relpath(pool_file, previous_path)) != self.package_config:
+                logging.info(
+                    f"{pool_file} was not built from the current config of {self.package_id}, so it will be built again")
+                return False
+            pool_files[kind] = pool_file
+
+        if prebuilt:
+            metadata = probe_package(asset['name'], lambda start, length: self.source.read_range(
+                asset, start, length))
+            if metadata is None:
+                return False
+            for pool_file in pool_files.values():
+                published = probe_package(pool_file, file_range(pool_file))
+                if published is None or [published[key] for key in ['name', 'version', 'architecture']] != [metadata[key] for key in ['name', 'version', 'architecture']]:
+                    logging.debug(
+                        f"{pool_file} is not the same package as {asset['name']}, so it will be downloaded again")
+                    return False
+
+        for kind, pool_file in pool_files.items():
+            self.result[f"{kind}_package_filename"] = os.path.basename(pool_file)
+            self.result[f"{kind}_package"] = os.path.join(
+                self.config["builddir"], os.path.basename(pool_file))
+            self.config["file_mover"].link(
+                pool_file, self.result[f"{kind}_package"])
+        logging.info(
+            f"Reusing the published packages of {self.package_id}: {', '.join(pool_files.values())}")
+        return True
+
+    def _extractAsset(self):
+        import tarfile
+        import zipfile
+
+        file_extensions = ['.tgz', '.gz', '.bz2', '.xz', '.zip']
+
+        if any(self.result['file'].endswith(ext) for ext in file_extensions):
+            # Named after the download, so each archive is unpacked once for
+            # every target which needs a file from it
+            unpack_dir = os.path.join(
+                self.config['workdir'], 'unpack', os.path.basename(os.path.dirname(self.result['file'])))
+
+            def extract():
+                # Only a complete extraction is ever renamed to unpack_dir, so
+                # one left by an earlier run can be used as it is
+                if os.path.exists(unpack_dir):
+                    return unpack_dir
+                partial_dir = f"{unpack_dir}.tmp"
+                if os.path.exists(partial_dir):
+                    shutil.rmtree(partial_dir)
+                # Unpack the file based on its extension
+                if self.result['file'].endswith('.zip'):
+                    with zipfile.ZipFile(self.result['file'], 'r') as zip_ref:
+                        zip_ref.extractall(partial_dir)
+                elif self.result['file'].endswith('.tgz') or self.result['file'].endswith('.gz'):
+                    with tarfile.open(self.result['file'], 'r:gz') as tar_ref:
+                        tar_ref.extractall(partial_dir)
+                elif self.result['file'].endswith('.bz2'):
+                    with tarfile.open(self.result['file'], 'r:bz2') as tar_ref:
+                        tar_ref.extractall(partial_dir)
+                elif self.result['file'].endswith('.xz'):
+                    with tarfile.open(self.result['file'], 'r:xz') as tar_ref:
+                        tar_ref.extractall(partial_dir)
+                os.rename(partial_dir, unpack_dir)
+                return unpack_dir
+
+            self.config["asset_cache"].get(f"unpack:{unpack_dir}", extract, os.path.exists)
+
+            binaries = self.result.get('binaries') or []
+            if len(binaries) > 0:
+                self.result['files'] = self._findBinaries(unpack_dir, binaries)
+                self.result['file'] = self.result['files'][0]
+            else:
+                file_regex = self.result.get(
+                    'file_regex', f"^{self.result['target_binary']}$")
+                for root, _, files in os.walk(unpack_dir):
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        if os.path.isfile(file_path) and re.match(file_regex, file):
+                            self.result['file'] = file_path
+
+    def _findBinaries(self, unpack_dir: str, binaries: list) -> list:
+        # Each entry in binaries is a file name or glob, matched against the
+        # file names in the archive. The first match of each name is used.
+        found = {}
+        for binary in binaries:
+            matched = False
+            for root, dirs, files in os.walk(unpack_dir):
+                dirs.sort()
+                for file in sorted(files):
+                    file_path = os.path.join(root, file)
+                    if os.path.isfile(file_path) and fnmatch.fnmatchcase(file, binary):
+                        matched = True
+                        if file not in found:
+                            found[file] = file_path
+            if not matched:
+                raise FileNotFoundError(
+                    f"No file in {self.result['name']} matches '{binary}' from binaries")
+        return list(found.values())
 
     def _set_ownership(self, directory_path, owner, group, directory_perm, file_perm):
         for root, dirs, files in os.walk(directory_path):
@@ -311,26 +604,120 @@ class TargetRelease:
                 f"Builddir Path not found {self.config['builddir']}")
 
         os.makedirs(os.path.join(self.package_path, 'usr', 'local', 'bin'))
-        shutil.copy(self.result['file'], os.path.join(
-            self.package_path, 'usr', 'local', 'bin', self.result['target_binary']))
+        if 'files' in self.result:
+            for file in self.result['files']:
+                shutil.copy(file, os.path.join(
+                    self.package_path, 'usr', 'local', 'bin', os.path.basename(file)))
+        else:
+            shutil.copy(self.result['file'], os.path.join(
+                self.package_path, 'usr', 'local', 'bin', self.result['target_binary']))
+        if self.result.get('strip'):
+            self.result['stripped_bytes'] = self._stripBinaries(
+                os.path.join(self.package_path, 'usr', 'local', 'bin'))
         self._set_ownership(self.package_path, 0, 0, 0o755, 0o755)
         # TODO: Support more autocomplete systems
         if 'bash' in self.result['autocomplete']:
             os.makedirs(os.path.join(self.package_path,
                         'etc', 'bash_completion.d'))
-            with open(os.path.join(self.package_path, 'etc', 'bash_completion.d', self.result['target_binary']), 'w') as file:
+            with open(os.path.join(self.package_path, 'etc', 'bash_completion.d', self.result['target_binary'] or self._packageName()), 'w') as file:
                 file.write(self.result['autocomplete']['bash'])
                 file.write("\n")
 
             self._set_ownership(os.path.join(
                 self.package_path, 'etc'), 0, 0, 0o644, 0o755)
 
+    def _stripBinaries(self, bin_dir: str) -> int:
+        # Strips each ELF binary in bin_dir (scripts are left as they are).
+        # With debug_package, what is stripped is kept in the tree of the debug
+        # packages, under /usr/lib/debug, where gdb finds it by the debuglink
+        # added to the binary. Returns how many bytes stripping saved.
+        saved = 0
+        debug_dir = os.path.join(self._debugPath(), 'usr', 'lib', 'debug', 'usr', 'local', 'bin')
+        for name in sorted(os.listdir(bin_dir)):
+            binary = os.path.join(bin_dir, name)
+            with open(binary, 'rb') as file:
+                if file.read(4) != b'\x7fELF':
+                    continue
+            size = os.path.getsize(binary)
+            command = ['objcopy', STRIP_ARGUMENTS[self.result['strip']]]
+            debug_file = None
+            if self.result.get('debug_package'):
+                os.makedirs(debug_dir, exist_ok=True)
+                debug_file = os.path.join(debug_dir, f"{name}.debug")
+                process = run_command(['objcopy', '--only-keep-debug', binary, debug_file], text=True)
+                if process.returncode > 0:
+                    logging.warning(
+                        f"Unable to keep the debug info of {name} for {self.package_id}, so it is packaged unstripped: {process.stderr.strip()}")
+                    continue
+                command.append(f"--add-gnu-debuglink={debug_file}")
+            process = run_command(command + [binary], text=True)
+            if process.returncode > 0:
+                # objcopy may not know the format of a binary for another architecture
+                logging.warning(
+                    f"Unable to strip {name} for {self.package_id}, so it is packaged unstripped: {process.stderr.strip()}")
+                if debug_file is not None and os.path.exists(debug_file):
+                    os.remove(debug_file)
+                continue
+            if debug_file is not None:
+                os.chmod(debug_file, 0o644)
+            saved += size - os.path.getsize(binary)
+            logging.debug(f"Stripped {name} for {self.package_id} from {size} to {os.path.getsize(binary)} bytes")
+        return saved
+
+    def _debCompressionArguments(self) -> str:
+        compression = self.result.get('debian_compression') or ''
+        if compression == '':
+            return ''
+        arguments = [f"-Z{compression}"]
+        level = self.result.get('debian_compression_level')
+        if level is not None and compression != 'none':
+            arguments.append(f"-z{level}")
+        if compression in ['xz', 'zstd']:
+            arguments.append(f"--threads-max={os.cpu_count()}")
+        return f"{' '.join(arguments)} "
+
+    def _rpmCompressionArguments(self) -> str:
+        compression = self.result.get('redhat_compression') or ''
+        if compression == '':
+            return ''
+        level = self.result.get('redhat_compression_level')
+        if level is None:
+            level = {'gzip': 9, 'xz': 6, 'zstd': 19}[compression]
+        payload_io = {'gzip': 'gzdio', 'xz': 'xzdio', 'zstd': 'zstdio'}[compression]
+        if compression == 'gzip':
+            payload = f"w{level}.{payload_io}"
+        else:
+            # rpm's xz and zstd writers can compress on several threads
+            payload = f"w{level}T{os.cpu_count()}.{payload_io}"
+        return f"--define '_binary_payload {payload}' "
+
+    def _recordBuild(self, kind: str, package_file: str, seconds: float):
+        if PACKAGE_KINDS[kind] == 'deb':
+            compression = self.result.get('debian_compression') or 'default'
+            level = self.result.get('debian_compression_level')
+        else:
+            compression = self.result.get('redhat_compression') or 'default'
+            level = self.result.get('redhat_compression_level')
+        if 'build_report' not in self.result:
+            self.result['build_report'] = []
+        self.result['build_report'].append({
+            "format": PACKAGE_KINDS[kind],
+            "package": os.path.basename(package_file),
+            "compression": compression,
+            "compression_level": level,
+            "seconds": round(seconds, 3),
+            "bytes": os.path.getsize(package_file),
+            # Taken out of the binaries of the package by strip
+            "bytes_saved": self.result.get('stripped_bytes') if kind in self.result['formats'] else None
+        })
+
     def _renderRpmPackage(self):
         if self.result['name'].endswith('.rpm'):
             self.result["rpm_package_filename"] = self.result['name']
             self.result["rpm_package"] = os.path.join(
                 self.config["builddir"], self.result['name'])
-            os.rename(self.result['file'], self.result["rpm_package"])
+            self.config["file_mover"].link(
+                self.result['file'], self.result["rpm_package"])
         else:
             rpmmap = [
                 's~^usr/include~%{_includedir}~',
@@ -357,146 +744,346 @@ class TargetRelease:
             rpmmap.append('s~^var~%{_localstatedir}~')
 
             self._preparePackage()
-            if not os.path.exists(os.path.join(self.config["workdir"], 'SPEC')):
-                os.makedirs(os.path.join(self.config["workdir"], 'SPEC'))
-            specfile = os.path.join(
-                self.config["workdir"], 'SPEC', f"{self.package_id}.spec")
-            content = [
-                f"Name:      {self.result['repo']}",
-                f"Version:   {self.result['versionNumber']}",
-                f"Release:   1",
-                f"Summary:   {self.result['description']}",
-                f"Source0:   {self.package_path}",
-                f"License:   {self.result['license']}",
-            ]
-            if 'redhat_dependencies' in self.result and self.result['redhat_dependencies'] != '':
+            self._buildRpm('rpm', self.package_path, rpmmap, self.result['description'],
+                           self.result.get('redhat_dependencies') or '')
+            if self.result.get('debug_package') and os.path.isdir(self._debugPath()):
+                self._buildRpm('rpm_debug', self._debugPath(), rpmmap,
+                               f"Debug information for {self._packageName()}",
+                               f"{self._packageName()} = {self.result['versionNumber']}-1")
+
+    def _buildRpm(self, kind: str, package_path: str, rpmmap: list, summary: str, requires: str):
+        # Builds the tree in package_path as the kind of package given (see
+        # PACKAGE_KINDS)
+        os.makedirs(os.path.join(
+            self.config["workdir"], 'SPEC'), exist_ok=True)
+        specfile = os.path.join(
+            self.config["workdir"], 'SPEC', f"{self.target_id}-{kind}.spec")
+        content = [
+            f"Name:      {self._packageName(kind)}",
+            f"Version:   {self.result['versionNumber']}",
+            f"Release:   1",
+            f"Summary:   {summary}",
+            f"Source0:   {package_path}",
+            f"License:   {self.result['license']}",
+        ]
+        if requires != '':
+            content.append(
+                f"Requires:  {requires}")
+        if 'homepage' in self.result and len(self.result['homepage']) > 0:
+            content.append(f"URL:       {self.result['homepage']}")
+        if kind != PACKAGE_KINDS[kind]:
+            # The debug info is packaged as it is, not stripped or split again
+            content.append(f"{'%'}global debug_package {'%'}{{nil}}")
+            content.append(f"{'%'}global __os_install_post {'%'}{{nil}}")
+        content.append("")
+        content.append(f"{'%'}description")
+        content.append(summary)
+        content.append("")
+        content.append(f"{'%'}prep")
+        content.append("")
+        content.append(f"{'%'}build")
+        content.append("")
+        content.append(f"{'%'}install")
+        install_files = []
+        for root, _, files in os.walk(os.path.join(package_path)):
+            for file in files:
+                file_path = os.path.join(root, file)
+                rpm_path_file = file_path.replace(
+                    f"{package_path}/", '')
+                for pattern in rpmmap:
+                    local_file = re.sub(pattern, '', rpm_path_file)
+                mode = '755' if os.access(
+                    file_path, os.X_OK) else '644'
                 content.append(
-                    f"Requires:  {self.result['redhat_dependencies']}")
-            if 'homepage' in self.result and len(self.result['homepage']) > 0:
-                content.append(f"URL:       {self.result['homepage']}")
-            content.append("")
-            content.append(f"{'%'}description")
-            content.append(self.result['description'])
-            content.append("")
-            content.append(f"{'%'}prep")
-            content.append("")
-            content.append(f"{'%'}build")
-            content.append("")
-            content.append(f"{'%'}install")
-            install_files = []
-            for root, _, files in os.walk(os.path.join(self.package_path)):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    rpm_path_file = file_path.replace(
-                        f"{self.package_path}/", '')
-                    for pattern in rpmmap:
-                        local_file = re.sub(pattern, '', rpm_path_file)
-                    mode = '755' if os.access(
-                        file_path, os.X_OK) else '644'
-                    content.append(
-                        f'install -D -m {mode} -o root -g root %{{SOURCE0}}/{local_file} ${{RPM_BUILD_ROOT}}/{rpm_path_file}')
-                    install_files.append(rpm_path_file)
-            content.append(f"{'%'}files")
-            for install_file in install_files:
-                content.append(f"/{install_file}")
-
-            with open(specfile, 'w') as file:
-                for line in content:
-                    file.write(f"{line}\n")
-
-            target_filename = f"{self.result['repo']}-{self.result['versionNumber']}-1.{self.result['redhat_architecture']}.rpm"
-            self.result["rpm_package_filename"] = target_filename
-            self.result["rpm_package"] = os.path.join(
-                self.config["builddir"], target_filename)
-            cmd = f"rpmbuild --target {self.result['redhat_architecture']} --define '_topdir {self.config['workdir']}' -bb {specfile}"
-            logging.debug(f"Executing command: {cmd}")
-            with subprocess.Popen(cmd, cwd=self.config["builddir"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-                exit_code = process.wait()
-                stdout = process.stdout.read().decode('utf-8')
-                stderr = process.stderr.read().decode('utf-8')
-                if exit_code > 0:
-                    logging.error(
-                        f"Build of {self.result['rpm_package']} failed")
-                    logging.error(f"stdout: {stdout}")
-                    logging.error(f"stderr: {stderr}")
-                    raise Exception("Build failure")
-
-            os.rename(os.path.join(
-                self.config['workdir'], 'RPMS', self.result['redhat_architecture'], target_filename), self.result["rpm_package"])
-
-            cmd = f'rpm --define "%_signature gpg" --define "%_gpg_name {self.config["privatekey_id"]}" --addsign "{self.result["rpm_package"]}"'
-            logging.debug(f"Executing command: {cmd}")
-            with subprocess.Popen(cmd, cwd=self.config["builddir"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-                exit_code = process.wait()
-                stdout = process.stdout.read().decode('utf-8')
-                stderr = process.stderr.read().decode('utf-8')
-                if exit_code > 0:
-                    logging.error(
-                        f"Signature {self.result['rpm_package']} failed")
-                    logging.error(f"stdout: {stdout}")
-                    logging.error(f"stderr: {stderr}")
-                    raise Exception("Signature failure")
-
-            logging.debug(
-                f"Build of {self.result['rpm_package']} succeeded")
+                    f'install -D -m {mode} -o root -g root %{{SOURCE0}}/{local_file} ${{RPM_BUILD_ROOT}}/{rpm_path_file}')
+                install_files.append(rpm_path_file)
+        content.append(f"{'%'}files")
+        for install_file in install_files:
+            content.append(f"/{install_file}")
+
+        with open(specfile, 'w') as file:
+            for line in content:
+                file.write(f"{line}\n")
+
+        target_filename = self._packageFilename(kind)
+        self.result[f"{kind}_package_filename"] = target_filename
+        self.result[f"{kind}_package"] = os.path.join(
+            self.config["builddir"], target_filename)
+        # rpmbuild takes its build time from SOURCE_DATE_EPOCH and clamps
+        # the file times to it, and the build host is fixed
+        reproducible = "--define '_buildhost reproducible' --define 'use_source_date_epoch_as_buildtime 1' --define 'clamp_mtime_to_source_date_epoch 1' "
+        cmd = f"rpmbuild --target {self.result['redhat_architecture']} --define '_topdir {self.config['workdir']}' {reproducible}{self._rpmCompressionArguments()}-bb {specfile}"
+        self._normaliseTree(package_path)
+        build_start = time.monotonic()
+        process = run_command(cmd, cwd=self.config["builddir"], shell=True, text=True, env=self._buildEnvironment())
+        if process.returncode > 0:
+            logging.error(
+                f"Build of {self.result[f'{kind}_package']} failed")
+            logging.error(f"stdout: {process.stdout}")
+            logging.error(f"stderr: {process.stderr}")
+            raise Exception("Build failure")
+
+        build_seconds = time.monotonic() - build_start
+        self.config["file_mover"].move(os.path.join(
+            self.config['workdir'], 'RPMS', self.result['redhat_architecture'], target_filename), self.result[f"{kind}_package"])
+        self._recordBuild(kind, self.result[f"{kind}_package"], build_seconds)
+
+        logging.debug(
+            f"Build of {self.result[f'{kind}_package']} succeeded")
+
+    def _signRpmPackage(self):
+        # Prebuilt packages keep the upstream signature
+        if self.result['name'].endswith('.rpm'):
+            return
+        signer = self.config.get("signer") or GpgSigner(key_id=self.config.get("privatekey_id") or None)
+        for kind in ["rpm", "rpm_debug"]:
+            if f"{kind}_package" in self.result and not self._keepSignedRpm(kind, signer):
+                signer.sign_rpm(self.result[f"{kind}_package"])
+
+    def _keepSignedRpm(self, kind: str, signer: GpgSigner) -> bool:
+        # A signature has the time it was made in it, so signing the same
+        # package again gives different bytes, and the pool and the metadata
+        # would change on every run. When the published package has the same
+        # header and payload, and is signed with the same key, it is used in
+        # place of the one just built.
+        previous_path = self._previousPath()
+        if previous_path is None:
+            return False
+        pool_file = os.path.join(previous_path, 'rpm', self.result[f"{kind}_package_filename"])
+        if not os.path.isfile(pool_file):
+            return False
+        try:
+            published = rpm_signed_content(pool_file)
+            built = rpm_signed_content(self.result[f"{kind}_package"])
+        except (ValueError, OSError, struct.error) as e:
+            logging.debug(f"Unable to compare {self.result[f'{kind}_package']} with {pool_file}: {e}")
+            return False
+        if published["digest"] != built["digest"] or not any(
+                signer.signed_by(signature) for signature in published["signatures"]):
+            return False
+        logging.debug(f"{pool_file} is the same package, already signed, so it is kept")
+        self.config["file_mover"].link(pool_file, self.result[f"{kind}_package"])
+        return True
 
     def _renderDebPackage(self):
         if self.result['name'].endswith('.deb'):
             self.result["deb_package_filename"] = self.result['name']
             self.result["deb_package"] = os.path.join(
                 self.config["builddir"], self.result['name'])
-            os.rename(self.result['file'], self.result["deb_package"])
+            self.config["file_mover"].link(
+                self.result['file'], self.result["deb_package"])
         else:
             self._preparePackage()
-            os.makedirs(os.path.join(self.package_path, 'DEBIAN'))
-            with open(os.path.join(self.package_path, 'DEBIAN', 'control'), 'w') as file:
-                content = [
-                    f"Package:      {self.result['repo']}",
-                    f"Version:      {self.result['versionNumber']}",
-                    f"Section:      {self.result['suite']}",
-                    f"Priority:     {self.result['priority'] or 'optional'}",
-                    f"Architecture: {self.result['debian_architecture']}",
-                ]
-                if 'debian_dependencies' in self.result and self.result['debian_dependencies'] != '':
-                    content.append(
-                        f"Depends:      {self.result['debian_dependencies']}")
+            content = [
+                f"Package:      {self._packageName()}",
+                f"Version:      {self.result['versionNumber']}",
+                f"Section:      {self.result['suite']}",
+                f"Priority:     {self.result['priority'] or 'optional'}",
+                f"Architecture: {self.result['debian_architecture']}",
+            ]
+            if 'debian_dependencies' in self.result and self.result['debian_dependencies'] != '':
                 content.append(
-                    f"Maintainer:   {self.result['maintainer']}")
+                    f"Depends:      {self.result['debian_dependencies']}")
+            content.append(
+                f"Maintainer:   {self.result['maintainer']}")
+            content.append(
+                f"Description:  {self.result['description']}")
+            if 'homepage' in self.result and len(self.result['homepage']) > 0:
                 content.append(
-                    f"Description:  {self.result['description']}")
-                if 'homepage' in self.result and len(self.result['homepage']) > 0:
-                    content.append(
-                        f"Homepage:     {self.result['homepage']}")
-                for line in content:
-                    file.write(f"{line}\n")
-
-            target_filename = f"{self.result['repo']}_{self.result['versionNumber']}_{self.result['debian_architecture']}.deb"
-            self.result["deb_package_filename"] = target_filename
-            self.result["deb_package"] = os.path.join(
-                self.config["builddir"], target_filename)
-            cmd = f"dpkg-deb --build {self.package_path} {target_filename}"
-            logging.debug(f"Executing command: {cmd}")
-            with subprocess.Popen(cmd, cwd=self.config["builddir"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-                exit_code = process.wait()
-                stdout = process.stdout.read().decode('utf-8')
-                stderr = process.stderr.read().decode('utf-8')
-                if exit_code > 0:
-                    logging.error(
-                        f"Build of {self.result['deb_package']} failed")
-                    logging.error(f"stdout: {stdout}")
-                    logging.error(f"stderr: {stderr}")
-                    raise Exception("Build failure")
+                    f"Homepage:     {self.result['homepage']}")
+            self._buildDeb('deb', self.package_path, content)
 
-                logging.debug(
-                    f"Build of {self.result['deb_package']} succeeded")
-            shutil.rmtree(self.package_path)
+            if self.result.get('debug_package') and os.path.isdir(self._debugPath()):
+                self._buildDeb('deb_debug', self._debugPath(), [
+                    f"Package:      {self._packageName('deb_debug')}",
+                    f"Version:      {self.result['versionNumber']}",
+                     "Section:      debug",
+                     "Priority:     optional",
+                    f"Architecture: {self.result['debian_architecture']}",
+                    f"Depends:      {self._packageName()} (= {self.result['versionNumber']})",
+                    f"Maintainer:   {self.result['maintainer']}",
+                    f"Description:  debug symbols for {self._packageName()}",
+                ])
+
+    def _buildDeb(self, kind: str, package_path: str, control: list):
+        # Builds the tree in package_path, with the control fields given, as
+        # the kind of package given (see PACKAGE_KINDS)
+        os.makedirs(os.path.join(package_path, 'DEBIAN'))
+        with open(os.path.join(package_path, 'DEBIAN', 'control'), 'w') as file:
+            for line in control:
+                file.write(f"{line}\n")
+
+        target_filename = self._packageFilename(kind)
+        self.result[f"{kind}_package_filename"] = target_filename
+        self.result[f"{kind}_package"] = os.path.join(
+            self.config["builddir"], target_filename)
+        os.chmod(os.path.join(package_path, 'DEBIAN'), 0o755)
+        os.chmod(os.path.join(package_path, 'DEBIAN', 'control'), 0o644)
+        # dpkg-deb sorts the files, and takes the time of the ar members
+        # from SOURCE_DATE_EPOCH. Every file is owned by root.
+        self._normaliseTree(package_path)
+        cmd = f"dpkg-deb --root-owner-group {self._debCompressionArguments()}--build {package_path} {target_filename}"
+        build_start = time.monotonic()
+        process = run_command(cmd, cwd=self.config["builddir"], shell=True, text=True, env=self._buildEnvironment())
+        if process.returncode > 0:
+            logging.error(
+                f"Build of {self.result[f'{kind}_package']} failed")
+            logging.error(f"stdout: {process.stdout}")
+            logging.error(f"stderr: {process.stderr}")
+            raise Exception("Build failure")
 
-    def getRelease(self):
-        self._getReleaseData()
-        self._getAsset()
+        logging.debug(
+            f"Build of {self.result[f'{kind}_package']} succeeded")
+        self._recordBuild(kind, self.result[f"{kind}_package"], time.monotonic() - build_start)
+        shutil.rmtree(package_path)
+
+    def _renderPackages(self):
+        # Clear out anything left by a build which was interrupted
+        for package_path in [self.package_path, self._debugPath()]:
+            if os.path.exists(package_path):
+                shutil.rmtree(package_path)
         if 'deb' in self.result['formats']:
-            self._renderDebPackage()
+            with profiler.stage("build_deb"):
+                self._renderDebPackage()
+        if 'rpm' in self.result['formats']:
+            with profiler.stage("build_rpm"):
+                self._renderRpmPackage()
+
+    def _signPackages(self):
         if 'rpm' in self.result['formats']:
-            self._renderRpmPackage()
-        if os.path.exists(os.path.join(self.package_path)):
-            shutil.rmtree(os.path.join(self.package_path))
+            self._signRpmPackage()
+
+    def _resume(self, journal: RunJournal) -> int:
+        # Restore this target from the journal of an earlier run, and return
+        # how many of its stages are already complete.
+        entry = journal.checkpoint(self.target_id)
+        if entry is None:
+            return 0
+        if entry["stage"] == 'resolved':
+            # Nothing was downloaded from the release, so it is looked up
+            # again: the asset which was missing may have been uploaded since
+            logging.info(
+                f"{self.target_id} did not get past resolving its release, so it will be started again")
+            return 0
+        result = entry["result"]
+        completed = STAGES.index(entry["stage"]) + 1
+
+        required_files = []
+        if entry["stage"] == 'published':
+            # The packages were moved into the output by the earlier run
+            required_files = [result[f"{kind}_pool_file"]
+                              for kind in PACKAGE_KINDS if f"{kind}_pool_file" in result]
+        elif completed >= STAGES.index('built') + 1:
+            required_files = [result[f"{kind}_package"]
+                              for kind in PACKAGE_KINDS if f"{kind}_package" in result]
+        elif completed >= STAGES.index('downloaded') + 1:
+            required_files = [result['file']]
+        if not all(os.path.exists(file) for file in required_files):
+            logging.info(
+                f"The files for {self.target_id} from the earlier run are missing, so it will be started again")
+            return 0
+
+        if entry["stage"] == 'published':
+            for kind in PACKAGE_KINDS:
+                if f"{kind}_pool_file" in result:
+                    self.config["file_mover"].link(
+                        result[f"{kind}_pool_file"], result[f"{kind}_package"])
+            completed = STAGES.index('signed') + 1
+
+        self.result = result
+        self.release = entry.get("release")
+        self.package_id = entry["package_id"]
+        self.package_path = entry["package_path"]
+        logging.info(
+            f"Resuming {self.target_id} after the {STAGES[completed - 1]} stage")
+        return completed
+
+    def _steps(self) -> dict:
+        return {
+            'resolved': self._getReleaseData,
+            'downloaded': self._getAsset,
+            'extracted': self._extractAsset,
+            'built': self._renderPackages,
+            'signed': self._signPackages
+        }
+
+    def startRelease(self, journal: RunJournal = None) -> str:
+        # Returns the first stage of getRelease still to run, or None if an
+        # earlier run completed them all
+        completed = 0
+        if journal is not None:
+            completed = self._resume(journal)
+        stages = list(self._steps())
+        if completed >= len(stages):
+            return None
+        return stages[completed]
+
+    def runStage(self, stage: str, journal: RunJournal = None) -> str:
+        # Runs one stage of getRelease, and returns the next one, or None if
+        # there is nothing more to do
+        if stage != 'resolved' and self.release is None:
+            logging.info(
+                f"{self.result['owner']}/{self.result['repo']} has fewer than {self.result.get('version_index', 0) + 1} matching releases, so there is no older version to keep here")
+            return None
+        profile_stages = {'resolved': 'resolve', 'downloaded': 'download',
+                          'extracted': 'extract', 'signed': 'sign'}
+        try:
+            if stage in profile_stages:
+                with profiler.stage(profile_stages[stage]):
+                    self._steps()[stage]()
+            else:
+                self._steps()[stage]()
+        except Exception as e:
+            if journal is not None:
+                journal.fail(self, stage, e)
+            raise
+        if journal is not None:
+            journal.record(self, stage)
+        if stage == 'resolved' and self.release is not None and self._reusePublished():
+            if journal is not None:
+                journal.record(self, 'signed')
+            return None
+
+        stages = list(self._steps())
+        if stages.index(stage) + 1 >= len(stages):
+            return None
+        return stages[stages.index(stage) + 1]
+
+    def finishRelease(self):
+        if getattr(self, 'package_path', None) is None:
+            return
+        for package_path in [self.package_path, self._debugPath()]:
+            if os.path.exists(package_path):
+                shutil.rmtree(package_path)
+
+    def downloadSize(self) -> int:
+        # The size of the asset to download, so the largest can go first
+        if self.release is None:
+            return 0
+        try:
+            return self.source.size(self._selectAsset())
+        except ValueError:
+            # Left for the download stage to report
+            return 0
+
+    def getRelease(self, journal: RunJournal = None):
+        stage = self.startRelease(journal)
+        while stage is not None:
+            stage = self.runStage(stage, journal)
+        self.finishRelease()
+
+    def adoptBuild(self, other):
+        # Takes the packages another target with the same settings built for
+        # another output, rather than downloading and building them again
+        self.release = other.release
+        self.package_id = getattr(other, 'package_id', None)
+        self.package_path = getattr(other, 'package_path', None)
+        self.result = dict(other.result)
+        for kind in PACKAGE_KINDS:
+            if f"{kind}_package" in other.result:
+                package = os.path.join(self.config["builddir"], os.path.basename(
+                    other.result[f"{kind}_package"]))
+                if package != other.result[f"{kind}_package"]:
+                    self.config["file_mover"].link(
+                        other.result[f"{kind}_package"], package)
+                self.result[f"{kind}_package"] = package
@@ -0,0 +1,281 @@
+import gzip
+import hashlib
+import io
+import logging
+import mmap
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from _profiler import run_command
+
+# Files at least this large are hashed through a memory map rather than read
+MMAP_THRESHOLD = 64 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+
+RELEASE_HASHES = {"MD5Sum": "md5", "SHA1": "sha1",
+                  "SHA256": "sha256", "SHA512": "sha512"}
+PACKAGES_HASHES = {"MD5sum": "md5", "SHA1": "sha1",
+                   "SHA256": "sha256", "SHA512": "sha512"}
+REPOMD_NAMESPACE = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NAMESPACE = "{http://linux.duke.edu/metadata/common}"
+
+
+def rpm_checksum_algorithm(checksum_type: str) -> str:
+    # Older createrepo versions call SHA-1 "sha"
+    return {"sha": "sha1"}.get(checksum_type, checksum_type)
+
+
+def hash_file(file_path: str, algorithms: list) -> dict:
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, CHUNK_SIZE):
+                        for hasher in hashers.values():
+                            hasher.update(view[offset:offset + CHUNK_SIZE])
+                finally:
+                    view.release()
+        else:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+class VerifyRepository:
+    def __init__(self, path: str, jobs: int = None, check_signatures: bool = True, public_key: str = None):
+        self.path = path
+        # A timestamped output directory holds its current snapshot in "latest"
+        if (
+            not os.path.isdir(os.path.join(path, "deb")) and
+            not os.path.isdir(os.path.join(path, "rpm")) and
+            os.path.isdir(os.path.join(path, "latest"))
+        ):
+            self.path = os.path.join(path, "latest")
+        self.jobs = jobs or os.cpu_count()
+        self.check_signatures = check_signatures
+        self.public_key = public_key
+        # Relative path -> list of (source, expected size, {algorithm: digest})
+        self.expectations = {}
+        self.results = []
+
+    def _expect(self, file_path: str, source: str, size: int, hashes: dict):
+        relative_path = os.path.relpath(file_path, self.path)
+        if relative_path not in self.expectations:
+            self.expectations[relative_path] = []
+        self.expectations[relative_path].append((source, size, hashes))
+
+    def _fail(self, file_path: str, message: str):
+        self.results.append((file_path, False, message))
+
+    def _parseRelease(self, release_file: str):
+        suite_dir = os.path.dirname(release_file)
+        source = os.path.relpath(release_file, self.path)
+        entries = {}
+        algorithm = None
+        with open(release_file, 'r') as file:
+            for line in file:
+                if not line.startswith(' '):
+                    algorithm = RELEASE_HASHES.get(line.split(':')[0].strip())
+                    continue
+                if algorithm is None:
+                    continue
+                digest, size, name = line.split()
+                if name not in entries:
+                    entries[name] = {"size": int(size), "hashes": {}}
+                entries[name]["hashes"][algorithm] = digest
+        for name, entry in entries.items():
+            self._expect(os.path.join(suite_dir, name),
+                         source, entry["size"], entry["hashes"])
+
+    def _parsePackages(self, packages_file: str):
+        source = os.path.relpath(packages_file, self.path)
+        with open(packages_file, 'r') as file:
+            stanzas = file.read().split("\n\n")
+        for stanza in stanzas:
+            fields = {}
+            for line in stanza.splitlines():
+                match = re.match(r'^([A-Za-z0-9-]+):\s*(.*)$', line)
+                if match:
+                    fields[match.group(1)] = match.group(2)
+            if "Filename" not in fields:
+                continue
+            hashes = {algorithm: fields[key]
+                      for key, algorithm in PACKAGES_HASHES.items() if key in fields}
+            size = int(fields["Size"]) if "Size" in fields else None
+            self._expect(os.path.join(self.path, "deb", fields["Filename"]),
+                         source, size, hashes)
+
+    def _parseRepomd(self, rpm_dir: str):
+        repomd_file = os.path.join(rpm_dir, "repodata", "repomd.xml")
+        source = os.path.relpath(repomd_file, self.path)
+        root = ElementTree.parse(repomd_file).getroot()
+        for data in root.findall(f"{REPOMD_NAMESPACE}data"):
+            location = data.find(f"{REPOMD_NAMESPACE}location").get("href")
+            checksum = data.find(f"{REPOMD_NAMESPACE}checksum")
+            size = data.find(f"{REPOMD_NAMESPACE}size")
+            self._expect(
+                os.path.join(rpm_dir, location), source,
+                int(size.text) if size is not None else None,
+                {rpm_checksum_algorithm(checksum.get("type")): checksum.text}
+            )
+            if data.get("type") == "primary":
+                self._parsePrimary(rpm_dir, os.path.join(rpm_dir, location))
+
+    def _openPrimary(self, primary_file: str):
+        # primary.xml as createrepo_c writes it, compressed or not, or None
+        # for a compression which cannot be read here
+        if primary_file.endswith(".gz"):
+            return gzip.open(primary_file, 'rb')
+        if primary_file.endswith(".xz"):
+            import lzma
+            return lzma.open(primary_file, 'rb')
+        if primary_file.endswith(".bz2"):
+            import bz2
+            return bz2.open(primary_file, 'rb')
+        if primary_file.endswith(".zst"):
+            result = run_command(['zstd', '--decompress', '--stdout', primary_file])
+            if result.returncode != 0:
+                raise ValueError(f"Unable to decompress: {result.stderr.decode().strip()}")
+            return io.BytesIO(result.stdout)
+        if primary_file.endswith(".xml"):
+            return open(primary_file, 'rb')
+        return None
+
+    def _parsePrimary(self, rpm_dir: str, primary_file: str):
+        if not os.path.exists(primary_file):
+            return
+        source = os.path.relpath(primary_file, self.path)
+        try:
+            file = self._openPrimary(primary_file)
+        except (OSError, ValueError) as e:
+            file = None
+            logging.debug(f"Unable to open {primary_file}: {e}")
+        if file is None:
+            # Otherwise no package in the pool would be checked, and the
+            # repository would still pass
+            self._fail(source, "unable to read the package list, so no RPM package could be verified")
+            return
+        with file:
+            for _, element in ElementTree.iterparse(file):
+                if element.tag != f"{COMMON_NAMESPACE}package":
+                    continue
+                location = element.find(f"{COMMON_NAMESPACE}location").get("href")
+                checksum = element.find(f"{COMMON_NAMESPACE}checksum")
+                size = element.find(f"{COMMON_NAMESPACE}size")
+                self._expect(
+                    os.path.join(rpm_dir, location), source,
+                    int(size.get("package")) if size is not None else None,
+                    {rpm_checksum_algorithm(checksum.get("type")): checksum.text}
+                )
+                element.clear()
+
+    def _checkFile(self, relative_path: str) -> tuple:
+        file_path = os.path.join(self.path, relative_path)
+        expectations = self.expectations[relative_path]
+        if not os.path.isfile(file_path):
+            return (relative_path, False, f"missing (listed in {', '.join(source for source, _, _ in expectations)})")
+
+        algorithms = set()
+        for _, _, hashes in expectations:
+            algorithms.update(hashes)
+        size = os.path.getsize(file_path)
+        digests = hash_file(file_path, sorted(algorithms))
+
+        problems = []
+        for source, expected_size, hashes in expectations:
+            if expected_size is not None and expected_size != size:
+                problems.append(
+                    f"size {size} does not match {expected_size} in {source}")
+            for algorithm, digest in hashes.items():
+                if digests[algorithm] != digest.lower():
+                    problems.append(
+                        f"{algorithm} {digests[algorithm]} does not match {digest} in {source}")
+        if len(problems) > 0:
+            return (relative_path, False, "; ".join(problems))
+        return (relative_path, True, f"{size} bytes, {', '.join(sorted(algorithms))} match")
+
+    def _checkSignature(self, gpg: list, relative_path: str, signed_file: str = None):
+        command = gpg + ['--verify', os.path.join(self.path, relative_path)]
+        if signed_file is not None:
+            command.append(os.path.join(self.path, signed_file))
+        if not os.path.exists(os.path.join(self.path, relative_path)):
+            return (relative_path, False, "signature missing")
+        result = run_command(command, text=True)
+        if result.returncode != 0:
+            return (relative_path, False, f"signature does not verify: {result.stderr.strip()}")
+        return (relative_path, True, "signature verifies")
+
+    def _signatureChecks(self, gpg: list) -> list:
+        checks = []
+        dists_dir = os.path.join(self.path, "deb", "dists")
+        if os.path.isdir(dists_dir):
+            for suite in sorted(os.listdir(dists_dir)):
+                suite_dir = os.path.relpath(
+                    os.path.join(dists_dir, suite), self.path)
+                checks.append((gpg, os.path.join(suite_dir, "InRelease")))
+                checks.append((gpg, os.path.join(suite_dir, "Release.gpg"),
+                               os.path.join(suite_dir, "Release")))
+        if os.path.exists(os.path.join(self.path, "rpm", "repodata", "repomd.xml")):
+            checks.append((gpg, os.path.join("rpm", "repodata", "repomd.xml.asc"),
+                           os.path.join("rpm", "repodata", "repomd.xml")))
+        return checks
+
+    def parseIndexes(self) -> dict:
+        # Returns what the indexes say about each file they list
+        dists_dir = os.path.join(self.path, "deb", "dists")
+        for root, _, files in os.walk(dists_dir):
+            for filename in files:
+                if filename == "Release" and os.path.dirname(root) == dists_dir:
+                    self._parseRelease(os.path.join(root, filename))
+                elif filename == "Packages":
+                    self._parsePackages(os.path.join(root, filename))
+        rpm_dir = os.path.join(self.path, "rpm")
+        if os.path.exists(os.path.join(rpm_dir, "repodata", "repomd.xml")):
+            self._parseRepomd(rpm_dir)
+        return self.expectations
+
+    def verify(self) -> bool:
+        self.parseIndexes()
+
+        if len(self.expectations) == 0:
+            self._fail(self.path, "no deb/dists/*/Release or rpm/repodata/repomd.xml found")
+            return False
+
+        with tempfile.TemporaryDirectory() as gnupghome:
+            gpg = ['gpg', '--batch']
+            if self.public_key is not None:
+                gpg += ['--homedir', gnupghome]
+                result = run_command(gpg + ['--import', self.public_key], text=True)
+                if result.returncode != 0:
+                    self._fail(self.public_key, f"unable to import: {result.stderr.strip()}")
+                    return False
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(self._checkFile, relative_path)
+                           for relative_path in sorted(self.expectations)]
+                if self.check_signatures:
+                    futures += [executor.submit(self._checkSignature, *check)
+                                for check in self._signatureChecks(gpg)]
+                for future in futures:
+                    self.results.append(future.result())
+
+        for file_path, ok, message in self.results:
+            if ok:
+                logging.info(f"OK: {file_path}: {message}")
+            else:
+                logging.error(f"FAILED: {file_path}: {message}")
+
+        failures = len([result for result in self.results if not result[1]])
+        logging.info(
+            f"Verified {len(self.results)} file(s) in {self.path}: {failures} failure(s)")
+        return failures == 0
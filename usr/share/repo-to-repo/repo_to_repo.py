@@ -1,25 +1,51 @@
 #!/usr/bin/env python3
 import os
+import sys
 import logging
 import argparse
 
 from _configuration import Configuration
-from _makeRepositories import MakeRepository, MakeDebRepository, MakeRPMRepository
 from _exceptions import NotRoot
+from _profiler import profiler
+
+# The in-process API, for workers which build one repository after another
+__all__ = ['BuildService', 'GpgSigner', 'SharedCache', 'RunService']
+
+
+def __getattr__(name: str):
+    # The build stack is only imported once it is used, so that --validate
+    # stays quick
+    if name == 'BuildService':
+        from _buildService import BuildService
+        return BuildService
+    if name == 'GpgSigner':
+        from _signer import GpgSigner
+        return GpgSigner
+    if name == 'SharedCache':
+        from _targetRelease import SharedCache
+        return SharedCache
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class RunService:
     def __init__(self):
         self.config: Configuration = None
 
-    def main(self):
+    def main(self, argv: list = None) -> int:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(levelname)s: %(message)s')
+        if argv is None:
+            argv = sys.argv[1:]
+        if len(argv) > 0 and argv[0] == 'verify':
+            return self.verify(argv[1:])
+        if len(argv) > 0 and argv[0] == 'serve':
+            return self.serve(argv[1:])
+
         parser = argparse.ArgumentParser(
             description="Turn a Github Release into a Linux Repository")
 
-        parser.add_argument("--config", required=True,
-                            help="Path to the config file")
+        parser.add_argument("--config", required=True, nargs='+',
+                            help="Path to the config file. Several files, or directories of *.json files, are built in one run which shares the downloads and the key between them.")
         parser.add_argument("--pgp-key", default=None,
                             help="Path to the PGP private key file. Override with `export pgp_key_base64='string'` for a base64 encoded string of the pgp key, or `export pgp_key='path'` for the path to the file.")
         parser.add_argument(
@@ -28,6 +54,16 @@ class RunService:
             '--quiet', '-q', action='store_true', help='Disable warnings')
         parser.add_argument('--output-path', '--output',
                             help="Override the config-defined path to the output.")
+        parser.add_argument('--workspace', default=None,
+                            help="Directory to hold the temporary build files. (Default: the directory containing the output path, so packages are moved rather than copied into place)")
+        parser.add_argument('--profile', default=None, metavar='DIR',
+                            help="Write cProfile, memory and subprocess timing reports for each stage of the run into DIR.")
+        parser.add_argument('--jobs', '-j', type=int, default=None,
+                            help="Number of targets each stage (resolve, download, extract, build and sign) works on at once; see stage_jobs in the README. (Default: the number of CPUs)")
+        parser.add_argument('--resume', action='store_true',
+                            help="Carry on from the workspace of an earlier run which failed, redoing only the unfinished stages of each target.")
+        parser.add_argument('--validate', action='store_true',
+                            help="Only validate the config file and exit. Needs no PGP key, no root and writes nothing to disk.")
 
         target_path = parser.add_mutually_exclusive_group()
         target_path.add_argument('--timestamp', '--timestamped-output', '-t', default="%Y%m%d%H%M%S",
@@ -35,48 +71,127 @@ class RunService:
         target_path.add_argument('--clean', '--clean-output', '-c', action='store_true',
                                  help="Do not include YYYYMMDDHHIISS in the final output path. (Default: OFF)")
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         if not args.debug:
             logging.disable(logging.DEBUG)
 
+        if args.profile is not None:
+            profiler.enable(args.profile)
+        try:
+            return self.run(args)
+        finally:
+            profiler.write()
+
+    def verify(self, argv: list) -> int:
+        parser = argparse.ArgumentParser(
+            prog="repo_to_repo.py verify",
+            description="Check that a generated repository matches its own indexes and signatures")
+        parser.add_argument("path",
+                            help="Path to the repository (the output path, or one snapshot in it)")
+        parser.add_argument("--public-key", default=None,
+                            help="Path to the PGP public key to check signatures with. (Default: the keys in the current GNUPGHOME)")
+        parser.add_argument("--no-signatures", action='store_true',
+                            help="Only check sizes and hashes, not the signatures.")
+        parser.add_argument("--jobs", "-j", type=int, default=None,
+                            help="Number of files to check at once. (Default: the number of CPUs)")
+        parser.add_argument(
+            '--debug', '-d', action='store_true', help='Enable debug logging')
+
+        args = parser.parse_args(argv)
+        if not args.debug:
+            logging.disable(logging.DEBUG)
+
+        from _verifyRepository import VerifyRepository
+
+        verifier = VerifyRepository(
+            args.path,
+            jobs=args.jobs,
+            check_signatures=not args.no_signatures,
+            public_key=args.public_key
+        )
+        if verifier.verify():
+            return 0
+        return 1
+
+    def serve(self, argv: list) -> int:
+        parser = argparse.ArgumentParser(
+            prog="repo_to_repo.py serve",
+            description="Serve a generated repository over HTTP, e.g. for test fleets")
+        parser.add_argument("path",
+                            help="Path to the repository (the output path, whose 'latest' snapshot is served, or one snapshot in it)")
+        parser.add_argument("--host", default="127.0.0.1",
+                            help="Address to listen on. (Default: 127.0.0.1)")
+        parser.add_argument("--port", "-p", type=int, default=8080,
+                            help="Port to listen on. (Default: 8080)")
+        parser.add_argument(
+            '--debug', '-d', action='store_true', help='Enable debug logging')
+
+        args = parser.parse_args(argv)
+        if not args.debug:
+            logging.disable(logging.DEBUG)
+
+        from _serveRepository import ServeRepository
+
+        try:
+            ServeRepository(args.path, args.host, args.port).serve()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def run(self, args):
+        if args.validate:
+            with profiler.stage("configuration"):
+                self.config = Configuration(args.config, args.pgp_key, args)
+                self.config.get_targets()
+            logging.info(
+                f"Configuration file(s) {', '.join(self.config.config_files)} valid, and define {len(self.config.targets)} target(s)")
+            return 0
+
         uid = os.getuid()
         if uid != 0:
             raise NotRoot("This script cannot proceed, as you are not root.")
 
-        self.config = Configuration(args.config, args.pgp_key, args)
-        self.config.load_pgp_privatekey()
-        self.config.get_targets()
+        with profiler.stage("configuration"):
+            self.config = Configuration(args.config, args.pgp_key, args)
+            self.config.get_targets()
+            self.config.create_workspace()
+            self.config.load_pgp_privatekey()
+
+        from _buildService import build_and_publish
 
-        debs = []
-        rpms = []
-        for target in self.config.targets:
-            target.getRelease()
-            if 'deb_package' in target.result:
-                debs.append(target)
-                logging.info(
-                    f"{target.result['repo']}/{target.result['owner']} release of {target.result['name']} for {target.result['architecture']} obtained and packaged: {target.result['deb_package']}")
+        # One set of connections for every request of the run
+        import requests
+        self.config.runtime_config["session"] = requests.Session()
 
-            if 'rpm_package' in target.result:
-                rpms.append(target)
-                logging.info(
-                    f"{target.result['repo']}/{target.result['owner']} release of {target.result['name']} for {target.result['architecture']} obtained and packaged: {target.result['rpm_package']}")
+        # Each output is published once, with the packages of every config
+        # which writes to it, as soon as the last of them is built
+        built, failed, _, _ = build_and_publish(
+            self.config.targets, self.config.runtime_config, self.config.outputs, self.config.journal)
+        failed = [target for target, _ in failed]
 
-        support = MakeRepository(self.config.runtime_config)
+        if len(built) > 0:
+            for target in self.config.targets:
+                if target not in failed:
+                    self.config.journal.record(target, 'published')
 
-        if len(debs) > 0:
-            MakeDebRepository(debs, self.config.runtime_config)
+        logging.info(self.config.runtime_config["file_mover"].report())
 
-        if len(rpms) > 0:
-            MakeRPMRepository(rpms, self.config.runtime_config)
+        if len(failed) > 0:
+            logging.error(
+                f"{len(failed)} of {len(self.config.targets)} target(s) failed. The workspace {self.config.runtime_config['basedir']} has been kept; rerun with --resume to retry only the unfinished stages")
+            return 1
 
-        support.finalize()
+        self.config.cleanUp()
+        return 0
 
 
 if __name__ == "__main__":
     service = RunService()
     try:
-        service.main()
+        sys.exit(service.main())
     except Exception as e:
         logging.error(e)
-        service.config.cleanUp()
+        if service.config is not None and "basedir" in service.config.runtime_config:
+            logging.error(
+                f"The workspace {service.config.runtime_config['basedir']} has been kept; rerun with --resume to carry on from where this run stopped")
         raise e